@@ -7,6 +7,7 @@ class RunningHubProcessRequest(BaseModel):
     task_id: str = Field(..., description="任务ID")
     episode: Optional[int] = Field(None, description="指定要处理的集数，不指定则处理所有集")
     auto_download: Optional[bool] = Field(True, description="是否自动下载图片")
+    cancel_on_disconnect: Optional[bool] = Field(False, description="客户端断开连接时是否取消该请求的RunningHub任务")
 
 
 class RunningHubTaskStatusRequest(BaseModel):
@@ -20,16 +20,16 @@ from app.services.runninghub import (
     get_task_result_service,
     cancel_task_service
 )
-from app.services.pdf_generation import generate_script_pdf_path_service
+from app.services.pdf_generation import generate_script_pdf_path_service, stream_script_pdf_service
 
 # 创建路由
 router = APIRouter()
 
 # 脚本生成路由
 @router.post("/stream/generate-script")
-async def stream_generate_script(request: StreamScriptGenerationRequest):
+async def stream_generate_script(request: StreamScriptGenerationRequest, http_request: Request):
     """流式生成脚本API"""
-    return await stream_generate_script_service(request)
+    return await stream_generate_script_service(request, http_request)
 
 # 取消生成任务
 @router.delete("/stream/cancel/{task_id}")
@@ -71,4 +71,10 @@ async def cancel_runninghub_task_route(request: RunningHubTaskCancelRequest):
 @router.get("/generate-script-pdf-path/{task_id}")
 async def generate_script_pdf_path(task_id: str, timeout: int = 60):
     """生成脚本PDF并返回路径"""
-    return await generate_script_pdf_path_service(task_id, timeout)
\ No newline at end of file
+    return await generate_script_pdf_path_service(task_id, timeout)
+
+# 流式生成脚本PDF，生成期间推送进度事件
+@router.get("/stream/generate-script-pdf/{task_id}")
+async def stream_generate_script_pdf(task_id: str):
+    """流式生成脚本PDF并推送进度"""
+    return await stream_script_pdf_service(task_id)
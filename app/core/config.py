@@ -39,12 +39,6 @@ MINIO_REGION = os.getenv("MINIO_REGION", "")  # 区域名称，可选
 # 是否将文件保存在本地（默认不保存本地，直接上传到MinIO）
 SAVE_FILES_LOCALLY = os.getenv("SAVE_FILES_LOCALLY", "false").lower() == "true"
 
-# 创建存储目录
-os.makedirs(GENERATION_STATES_DIR, exist_ok=True)
-os.makedirs(PARTIAL_CONTENTS_DIR, exist_ok=True)
-os.makedirs(PDFS_DIR, exist_ok=True)  # 确保PDF目录存在
-os.makedirs(IMAGES_DIR, exist_ok=True)  # 确保图片目录存在
-
 # 令牌限制
 DIRECTORY_TOKEN_LIMIT = 5000 # 目录生成限制
 EPISODE_TOKEN_LIMIT = 10000 # 单集生成限制
@@ -52,6 +46,15 @@ EPISODE_TOKEN_LIMIT = 10000 # 单集生成限制
 # 请求超时(秒)
 REQUEST_TIMEOUT = 600
 
+# 阻塞I/O线程池大小（文件检查、目录扫描等通过asyncio.to_thread执行）
+BLOCKING_IO_WORKERS = int(os.getenv("BLOCKING_IO_WORKERS", "32"))
+
+# 同时进行的上游生成请求上限，避免并发过高触发429限流
+MAX_EPISODES_INFLIGHT = int(os.getenv("MAX_EPISODES_INFLIGHT", "5"))
+
+# 同时进行的图片下载上限，避免大量子任务同时完成时耗尽连接和内存
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv("MAX_CONCURRENT_DOWNLOADS", "16"))
+
 # RunningHub API 设置
 # 创建任务API
 RUNNINGHUB_CREATE_API_URL = os.getenv("RUNNINGHUB_CREATE_API_URL", "")
@@ -1,27 +1,33 @@
 import os
+import logging
 import pickle
 import time
-import json
-import httpx
+import orjson
 import asyncio
 from typing import Dict, Optional, List, Any, Tuple
 import uuid
 from datetime import datetime
 from enum import Enum
 from app.core.config import (
-    MODEL_NAME, API_VERSION, REQUEST_TIMEOUT,
-    DIRECTORY_TOKEN_LIMIT, EPISODE_TOKEN_LIMIT,
+    REQUEST_TIMEOUT,
+    EPISODE_TOKEN_LIMIT,
     GENERATION_STATES_DIR, 
     PARTIAL_CONTENTS_DIR,
     MINIO_ENABLED,
     SAVE_FILES_LOCALLY
 )
+from app.core.http_client import (
+    get_http_client, iter_sse_data, read_error_text, select_delta_extractor, retry_backoff, upstream_headers,
+    upstream_stream, RETRYABLE_STATUS_CODES
+)
 from app.utils.text_utils import extract_title_and_directory
 from app.utils.storage import save_partial_content
 from app.utils.minio_storage import minio_client, get_state_object_name, get_content_object_name
 
 # 导入从generator_part2.py
-from app.core.generator_part2 import generate_episode
+from app.core.generator_part2 import generate_episode, ClientDisconnected
+
+logger = logging.getLogger(__name__)
 
 async def generate_character_and_directory(
     genre, 
@@ -33,7 +39,7 @@ async def generate_character_and_directory(
     client_id=None,
     content_callback=None  # 添加回调函数参数
 ):
-    print(f"\n==== 生成角色表和目录 ====")
+    logger.info("==== 生成角色表和目录 ====")
     
     prompt = f"""
     [角色]
@@ -90,22 +96,18 @@ async def generate_character_and_directory(
     -不需要生成每集简介，只生成目录
     """
     
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {API_KEY}",
-        "anthropic-version": API_VERSION
-    }
+    # 增量先放入列表，只在返回时拼接一次，避免逐块拼接字符串
+    content_parts = []
     
-    payload = {
-        "model": MODEL_NAME,
+    # 请求体只序列化一次，重试时直接复用
+    request_headers = upstream_headers(API_KEY)
+    request_body = orjson.dumps({
+        "model": "claude-3-7-sonnet-20250219",
         "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": DIRECTORY_TOKEN_LIMIT,
         "temperature": 0.7,
         "stream": True
-    }
-    
-    print(f"请求角色表和目录，模型: {payload['model']}")
-    initial_content = ""
+    })
+    logger.debug("请求角色表和目录，请求体大小: %d 字节", len(request_body))
     
     try:
         max_retries = 3
@@ -113,71 +115,73 @@ async def generate_character_and_directory(
         
         while retry_count < max_retries:
             try:
-                print(f"角色表和目录 - 尝试 {retry_count+1}/{max_retries}")
-                async with httpx.AsyncClient(timeout=120.0) as client:
-                    # 创建请求但不等待整个响应完成
-                    async with client.stream(
-                        "POST", 
-                        API_URL,
-                        headers={"Authorization": f"Bearer {API_KEY}"},
-                        json={
-                            "model": "claude-3-7-sonnet-20250219",
-                            "messages": [{"role": "user", "content": prompt}],
-                            "temperature": 0.7,
-                            "stream": True
-                        },
-                        timeout=120.0
-                    ) as response:
-                        # 检查响应状态
-                        if response.status_code != 200:
-                            print(f"API错误响应: {response.status_code}")
-                            error_text = await response.text()
-                            print(f"错误详情: {error_text}")
-                            raise Exception(f"API请求失败，状态码: {response.status_code}")
+                logger.debug("角色表和目录 - 尝试 %d/%d", retry_count + 1, max_retries)
+                client = get_http_client()
+                # 创建请求但不等待整个响应完成
+                async with upstream_stream(
+                    client,
+                    "POST", 
+                    API_URL,
+                    headers=request_headers,
+                    content=request_body,
+                    timeout=120.0
+                ) as response:
+                    # 检查响应状态
+                    if response.status_code != 200:
+                        logger.warning("API错误响应: %s", response.status_code)
+                        error_text = await read_error_text(response)
+                        logger.warning("错误详情: %s", error_text)
+                        if response.status_code not in RETRYABLE_STATUS_CODES:
+                            # 鉴权、参数等不可恢复的错误直接返回，不再重试
+                            return f"API配置错误: {response.status_code}"
+                        raise Exception(f"API请求失败，状态码: {response.status_code}")
                         
-                        # 一定要使用这种方式处理流式响应
-                        async for chunk in response.aiter_bytes():
-                            if chunk:
-                                try:
-                                    # 解码为文本
-                                    text_chunk = chunk.decode('utf-8')
-                                    # 处理每行数据
-                                    for line in text_chunk.split('\n'):
-                                        if line.startswith('data: '):
-                                            if line.strip() == 'data: [DONE]':
-                                                break
-                                            
-                                            data = json.loads(line[6:])
-                                            delta = ""
-                                            
-                                            # 提取文本增量
-                                            if "choices" in data and data["choices"]:
-                                                delta = data["choices"][0].get("delta", {}).get("content", "")
-                                            
-                                            if delta:
-                                                # 重要：同时累积内容
-                                                initial_content += delta
-                                                
-                                                if content_callback:
-                                                    await content_callback(delta)
-                                except Exception as e:
-                                    print(f"处理流式数据出错: {str(e)}")
+                    extract_delta = None
+                    
+                    # 按行解析SSE数据，负载以字节形式直接交给orjson
+                    async for payload in iter_sse_data(response):
+                        try:
+                            data = orjson.loads(payload)
+                            # 第一个事件确定响应格式，之后直接调用对应的提取函数
+                            if extract_delta is None:
+                                extract_delta = select_delta_extractor(data)
+                            delta = extract_delta(data)
+                                
+                            if delta:
+                                # 重要：同时累积内容
+                                content_parts.append(delta)
+                                    
+                                if content_callback and await content_callback(delta) is False:
+                                    raise ClientDisconnected()
+                        except ClientDisconnected:
+                            raise
+                        except Exception as e:
+                            logger.warning("处理流式数据出错: %s", e)
                         
-                        # 返回累积的内容
-                        print(f"角色表和目录生成完成，累积内容长度: {len(initial_content)}")
-                        return initial_content
+                    # 返回累积的内容
+                    initial_content = "".join(content_parts)
+                    logger.info("角色表和目录生成完成，累积内容长度: %d", len(initial_content))
+                    return initial_content
+            except asyncio.CancelledError:
+                # 任务被取消时立即向上传播，不进入重试
+                raise
+            except ClientDisconnected:
+                logger.info("客户端已断开，停止生成角色表和目录")
+                return "".join(content_parts)
             except Exception as e:
-                print(f"角色表和目录生成请求出错 (尝试 {retry_count+1}/{max_retries}): {str(e)}")
+                logger.warning("角色表和目录生成请求出错 (尝试 %d/%d): %s", retry_count + 1, max_retries, e)
                 retry_count += 1
                 if retry_count >= max_retries:
                     return "角色表和目录生成出错，但将继续生成剧本内容。"
-                await asyncio.sleep(2)  # 等待2秒后重试
+                # 退避期间不持有上游准入名额，名额可被其他请求使用
+                await asyncio.sleep(retry_backoff(retry_count))
                 
+        initial_content = "".join(content_parts)
         if not initial_content:
             initial_content = "角色表和目录生成失败，但将继续生成剧本内容。"
     except Exception as e:
-        print(f"角色表和目录生成出错: {str(e)}")
+        logger.error("角色表和目录生成出错: %s", e)
         initial_content = "角色表和目录生成出错，但将继续生成剧本内容。"
     
-    print(f"角色表和目录生成完成，长度: {len(initial_content)} 字符")
+    logger.info("角色表和目录生成完成，长度: %d 字符", len(initial_content))
     return initial_content 
\ No newline at end of file
@@ -1,22 +1,43 @@
-import json
+import logging
 import httpx
+import orjson
 import asyncio
+import time
 from app.core.config import MODEL_NAME, API_VERSION, REQUEST_TIMEOUT
 from app.core.config import EPISODE_TOKEN_LIMIT
+from app.core.http_client import (
+    get_http_client, iter_sse_data, read_error_text, select_delta_extractor, retry_backoff, upstream_headers,
+    upstream_stream, RETRYABLE_STATUS_CODES
+)
 from app.utils.text_utils import extract_title_and_directory
-from app.utils.storage import save_partial_content
-from typing import Optional, Callable, Awaitable
+from app.utils.storage import queue_partial_content
+from contextlib import aclosing
+from functools import lru_cache
+from typing import Optional, Callable, Awaitable, AsyncIterator
 
-async def generate_episode(ep, genre, episodes, duration, full_script, API_KEY, API_URL, client_id=None, content_callback=None):
-    """生成单集内容"""
-    print(f"\n==== 生成第{ep}集剧本 ====")
-    
-    # 检查API设置
-    if not API_KEY or not API_URL:
-        print(f"错误: 缺少API设置。API_KEY: {'已设置' if API_KEY else '未设置'}, API_URL: {'已设置' if API_URL else '未设置'}")
-        return f"生成失败: API密钥或URL未正确设置。"
-    
-    prompt = f"""
+logger = logging.getLogger(__name__)
+
+# 部分内容落盘节流：累积超过PARTIAL_FLUSH_BYTES个字符或距上次保存超过PARTIAL_FLUSH_INTERVAL秒才保存一次
+PARTIAL_FLUSH_BYTES = 4096
+PARTIAL_FLUSH_INTERVAL = 1.0
+
+# 回调合并：增量攒够CALLBACK_FLUSH_CHARS个字符或距上次推送超过CALLBACK_FLUSH_INTERVAL秒才调用一次content_callback
+CALLBACK_FLUSH_CHARS = 64
+CALLBACK_FLUSH_INTERVAL = 0.016
+
+
+class ClientDisconnected(Exception):
+    """内容回调返回False时抛出，表示下游客户端已断开"""
+
+
+class EpisodeGenerationError(Exception):
+    """单集生成失败，异常消息即发送给客户端的错误文本"""
+
+
+@lru_cache(maxsize=32)
+def build_static_prompt(genre, episodes, duration) -> str:
+    """构建提示词的静态指令部分，同一部剧的每一集参数相同，直接复用缓存的字符串"""
+    return f"""
     [角色]
     你是一位AI短剧生成器，专门自动输出{genre}题材短剧内容。
 
@@ -33,7 +54,7 @@ async def generate_episode(ep, genre, episodes, duration, full_script, API_KEY,
     [任务]
     根据预设参数自动生成以下内容：
     1.每集详细剧本（符合分集撰写要求）
-    2.基于以下已有内容，请仅生成第{ep}集的完整剧本内容。
+    2.基于以下已有内容，请仅生成[重要提示]中指定集数的完整剧本内容。
 
     [预设参数]
     题材：{genre}
@@ -169,12 +190,34 @@ async def generate_episode(ep, genre, episodes, duration, full_script, API_KEY,
     #<Based on the detailed scene description above, generate an image prompt describing the environment, atmosphere, or key actions. Structure the prompt to include: descriptions of all characters in the scene, scene setting, color tone and lighting, style keywords and mood. Each image prompt should flow as a cohesive paragraph with logical and orderly content. Avoid abstract terms and bulleted descriptions. The prompt should be directly usable in AI drawing software to generate the corresponding image>
 
     (完)
+    """
+
+
+async def stream_episode(ep, genre, episodes, duration, full_script, API_KEY, API_URL) -> AsyncIterator[str]:
+    """流式生成单集内容，逐个产出文本增量
+
+    读取节奏由调用方驱动：下游写入变慢时，上游响应的读取也随之暂停。
+    已经产出过内容的请求失败后不再重试，避免下游收到重复内容；最终失败时抛出EpisodeGenerationError。
+    """
+    logger.info("==== 生成第%s集剧本 ====", ep)
     
+    # 检查API设置
+    if not API_KEY or not API_URL:
+        logger.error("错误: 缺少API设置。API_KEY: %s, API_URL: %s", "已设置" if API_KEY else "未设置", "已设置" if API_URL else "未设置")
+        raise EpisodeGenerationError("生成失败: API密钥或URL未正确设置。")
+    
+    # 静态指令部分：同一部剧的每一集都相同，标记为可缓存前缀
+    static_prompt = build_static_prompt(genre, episodes, duration)
+    
+    # 动态部分：剧本基础信息、最近剧情和当前集数，在重试循环之前只计算一次
+    title_dir = extract_title_and_directory(full_script)
+    recent_script = full_script[-1500:]
+    dynamic_prompt = f"""
     [剧本基础信息]
-    {extract_title_and_directory(full_script)}
+    {title_dir}
     
     [最近剧情]
-    {full_script[-1500:]}
+    {recent_script}
 
     [重要提示]
     必须严格使用上方[剧本基础信息]中的剧名和分集目录。
@@ -184,99 +227,166 @@ async def generate_episode(ep, genre, episodes, duration, full_script, API_KEY,
     绘画风格为写实风格，不要使用卡通人物。
     """
     
-    try:
-        max_retries = 3
-        retry_count = 0
-        
-        while retry_count < max_retries:
-            try:
-                print(f"第{ep}集 - 尝试 {retry_count+1}/{max_retries}")
-                async with httpx.AsyncClient(timeout=120.0) as client:
-                    # 创建请求但不等待整个响应完成
-                    print(f"开始发送API请求到: {API_URL}")
-                    async with client.stream(
-                        "POST", 
-                        API_URL,
-                        headers={"Authorization": f"Bearer {API_KEY}"},
-                        json={
-                            "model": "claude-3-7-sonnet-20250219",
-                            "messages": [{"role": "user", "content": prompt}],
-                            "temperature": 0.7,
-                            "max_tokens": EPISODE_TOKEN_LIMIT,
-                            "stream": True
-                        },
-                        timeout=120.0
-                    ) as response:
-                        # 检查响应状态
-                        print(f"收到API响应，状态码: {response.status_code}")
-                        if response.status_code != 200:
-                            print(f"API错误响应: {response.status_code}")
-                            error_text = await response.text()
-                            print(f"错误详情: {error_text}")
-                            raise Exception(f"API请求失败，状态码: {response.status_code}")
-                        
-                        # 处理流式响应
-                        episode_content = ""
-                        chunk_count = 0
-                        
-                        async for chunk in response.aiter_bytes():
-                            if chunk:
-                                try:
-                                    # 解码为文本
-                                    text_chunk = chunk.decode('utf-8')
-                                    # 处理每行数据
-                                    for line in text_chunk.split('\n'):
-                                        if line.startswith('data: '):
-                                            if line.strip() == 'data: [DONE]':
-                                                print("收到[DONE]标记，流式响应完成")
-                                                break
-                                            
-                                            try:
-                                                data = json.loads(line[6:])
-                                                delta = ""
-                                                
-                                                # 提取文本增量
-                                                if "choices" in data and data["choices"]:
-                                                    delta = data["choices"][0].get("delta", {}).get("content", "")
-                                                elif "type" in data and data.get("type") == "content_block_delta":
-                                                    delta = data.get("delta", {}).get("text", "")
-                                                
-                                                if delta:
-                                                    # 重要：同时累积内容
-                                                    episode_content += delta
-                                                    chunk_count += 1
-                                                    
-                                                    if chunk_count % 10 == 0:
-                                                        print(f"已接收{chunk_count}个文本块，当前内容长度: {len(episode_content)}")
-                                                    
-                                                    if content_callback:
-                                                        await content_callback(delta)
-                                            except json.JSONDecodeError as je:
-                                                print(f"JSON解析错误: {str(je)}, 行内容: {line[:50]}...")
-                                except Exception as e:
-                                    print(f"处理流式数据块出错: {str(e)}")
+    # 请求体只序列化一次，重试时直接复用
+    request_headers = upstream_headers(API_KEY, prompt_caching=True)
+    request_body = orjson.dumps({
+        "model": "claude-3-7-sonnet-20250219",
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": static_prompt, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": dynamic_prompt}
+            ]
+        }],
+        "temperature": 0.7,
+        "max_tokens": EPISODE_TOKEN_LIMIT,
+        "stream": True
+    })
+    
+    max_retries = 3
+    retry_count = 0
+    
+    while retry_count < max_retries:
+        streamed = False
+        try:
+            logger.debug("第%s集 - 尝试 %d/%d", ep, retry_count + 1, max_retries)
+            client = get_http_client()
+            # 创建请求但不等待整个响应完成
+            logger.debug("开始发送API请求到: %s", API_URL)
+            async with upstream_stream(
+                client,
+                "POST", 
+                API_URL,
+                headers=request_headers,
+                content=request_body,
+                timeout=120.0
+            ) as response:
+                # 检查响应状态
+                logger.debug("收到API响应，状态码: %s", response.status_code)
+                if response.status_code != 200:
+                    logger.warning("API错误响应: %s", response.status_code)
+                    error_text = await read_error_text(response)
+                    logger.warning("错误详情: %s", error_text)
+                    if response.status_code not in RETRYABLE_STATUS_CODES:
+                        # 鉴权、参数等不可恢复的错误直接返回，不再重试
+                        raise EpisodeGenerationError(f"API配置错误: {response.status_code}")
+                    raise Exception(f"API请求失败，状态码: {response.status_code}")
+                
+                # 处理流式响应
+                content_length = 0
+                chunk_count = 0
+                extract_delta = None
+                
+                # 按行解析SSE数据，负载以字节形式直接交给orjson
+                async for payload in iter_sse_data(response):
+                    try:
+                        data = orjson.loads(payload)
+                        # 第一个事件确定响应格式，之后直接调用对应的提取函数
+                        if extract_delta is None:
+                            extract_delta = select_delta_extractor(data)
+                        delta = extract_delta(data)
+                    except orjson.JSONDecodeError as je:
+                        logger.warning("JSON解析错误: %s, 行内容: %.50s...", je, payload)
+                        continue
+                    except Exception as e:
+                        logger.warning("处理流式数据块出错: %s", e)
+                        continue
+                    
+                    if delta:
+                        content_length += len(delta)
+                        chunk_count += 1
                         
-                        print(f"第{ep}集内容生成完成，总长度: {len(episode_content)} 字符")
-                        return episode_content
+                        if chunk_count % 10 == 0:
+                            logger.debug("已接收%d个文本块，当前内容长度: %d", chunk_count, content_length)
                         
-            except httpx.TimeoutException as e:
-                print(f"API请求超时: {str(e)}")
-                retry_count += 1
-                if retry_count >= max_retries:
-                    if content_callback:
-                        await content_callback("\n\n[生成超时，请刷新重试]")
-                    return "生成超时，请刷新重试"
-                await asyncio.sleep(2)
-            except Exception as e:
-                print(f"第{ep}集生成请求出错: {str(e)}")
-                retry_count += 1
-                if retry_count >= max_retries:
-                    if content_callback:
-                        await content_callback(f"\n\n[生成失败: {str(e)}]")
-                    return f"生成失败: {str(e)}"
-                await asyncio.sleep(2)
+                        streamed = True
+                        yield delta
+                
+                logger.info("第%s集内容生成完成，总长度: %d 字符", ep, content_length)
+                return
+                
+        except (asyncio.CancelledError, EpisodeGenerationError):
+            # 任务被取消或不可恢复的错误立即向上传播，不进入重试
+            raise
+        except httpx.TimeoutException as e:
+            logger.warning("API请求超时: %s", e)
+            retry_count += 1
+            if streamed or retry_count >= max_retries:
+                raise EpisodeGenerationError("生成超时，请刷新重试") from e
+            # 退避期间不持有上游准入名额，名额可被其他剧集使用
+            await asyncio.sleep(retry_backoff(retry_count))
+        except Exception as e:
+            logger.warning("第%s集生成请求出错: %s", ep, e)
+            retry_count += 1
+            if streamed or retry_count >= max_retries:
+                raise EpisodeGenerationError(f"生成失败: {str(e)}") from e
+            # 退避期间不持有上游准入名额，名额可被其他剧集使用
+            await asyncio.sleep(retry_backoff(retry_count))
+
+
+async def generate_episode(ep, genre, episodes, duration, full_script, API_KEY, API_URL, client_id=None, content_callback=None):
+    """生成单集内容，通过content_callback推送增量并返回完整内容，生成失败时抛出EpisodeGenerationError
+
+    增量按字符数/时间窗口合并后再推送给content_callback，减少逐token的await调度。
+    提供client_id时按字节数/时间间隔节流保存部分内容，结束时（包括客户端断开和任务取消）再保存一次，避免丢失最后的内容。
+    """
+    parts = []
+    running_len = 0
+    last_flush_len = 0
+    last_flush_ts = time.monotonic()
+    cb_buf = []
+    cb_len = 0
+    cb_last = last_flush_ts
+    
+    try:
+        async with aclosing(stream_episode(ep, genre, episodes, duration, full_script, API_KEY, API_URL)) as stream:
+            async for delta in stream:
+                parts.append(delta)
+                running_len += len(delta)
+                
+                now = time.monotonic()
+                
+                if client_id:
+                    if running_len - last_flush_len >= PARTIAL_FLUSH_BYTES or now - last_flush_ts >= PARTIAL_FLUSH_INTERVAL:
+                        queue_partial_content(client_id, ep, "".join(parts))
+                        last_flush_len = running_len
+                        last_flush_ts = now
+                
+                if content_callback:
+                    cb_buf.append(delta)
+                    cb_len += len(delta)
+                    if cb_len >= CALLBACK_FLUSH_CHARS or now - cb_last >= CALLBACK_FLUSH_INTERVAL:
+                        chunk = "".join(cb_buf)
+                        cb_buf.clear()
+                        cb_len = 0
+                        cb_last = now
+                        if await content_callback(chunk) is False:
+                            raise ClientDisconnected()
+            
+            # 推送最后一批未达到阈值的增量
+            if content_callback and cb_buf:
+                chunk = "".join(cb_buf)
+                cb_buf.clear()
+                if await content_callback(chunk) is False:
+                    raise ClientDisconnected()
+    except ClientDisconnected:
+        # 离开aclosing时上游流随之关闭，不再继续消耗token
+        logger.info("第%s集客户端已断开，停止生成", ep)
+    except asyncio.CancelledError:
+        # 取消同样会关闭上游流；已生成的内容由finally提交保存后再向上传播
+        logger.info("第%s集生成任务被取消，已生成 %d 字符", ep, running_len)
+        raise
+    except EpisodeGenerationError:
+        # 错误不能混入剧集内容返回，交给调用方发送错误事件；已生成的部分内容由finally保存
+        if content_callback and cb_buf:
+            await content_callback("".join(cb_buf))
+        raise
     except Exception as e:
-        print(f"第{ep}集生成过程中发生严重错误: {str(e)}")
-        if content_callback:
-            await content_callback(f"\n\n[系统错误: {str(e)}]")
-        return f"系统错误: {str(e)}" 
\ No newline at end of file
+        logger.error("第%s集生成过程中发生严重错误: %s", ep, e)
+        raise EpisodeGenerationError(f"系统错误: {str(e)}") from e
+    finally:
+        # 最后一批增量可能未达到节流阈值，这里补一次保存
+        if client_id and running_len > last_flush_len:
+            queue_partial_content(client_id, ep, "".join(parts))
+    
+    return "".join(parts)
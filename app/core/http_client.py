@@ -0,0 +1,131 @@
+import asyncio
+import random
+import httpx
+from contextlib import AsyncExitStack, asynccontextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Optional, Tuple
+from app.core.config import API_VERSION, MAX_EPISODES_INFLIGHT, REQUEST_TIMEOUT
+
+# 可重试的上游状态码，其余非200状态（如401/403/400/404）视为配置错误，不再重试
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+# 重试退避上限（秒），避免失败请求长时间占用生成流程
+MAX_RETRY_BACKOFF = 3.0
+
+# 上游请求准入控制，限制同时建立中的流式生成请求数；收到响应头即释放，不随下游读取速度占用
+upstream_semaphore = asyncio.Semaphore(MAX_EPISODES_INFLIGHT)
+
+# 共享的HTTP客户端，所有剧本生成请求复用同一个连接池
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的AsyncClient（启用HTTP/2，多个剧集流复用同一连接）"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=32),
+            timeout=REQUEST_TIMEOUT
+        )
+    return _client
+
+
+@asynccontextmanager
+async def upstream_stream(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+    """在上游准入名额内发起流式请求，收到响应头后即释放名额
+
+    名额只限制同时建立的连接数，避免突发请求触发429；读取响应体期间不持有名额，
+    下游客户端暂停读取时不会占住名额阻塞其他生成请求。
+    """
+    async with AsyncExitStack() as stack:
+        async with upstream_semaphore:
+            response = await stack.enter_async_context(client.stream(method, url, **kwargs))
+        yield response
+
+
+@lru_cache(maxsize=8)
+def upstream_headers(api_key: str, prompt_caching: bool = False) -> Tuple[Tuple[str, str], ...]:
+    """按API密钥缓存上游请求头，httpx可直接接受(name, value)元组序列
+
+    prompt_caching为True时附加Anthropic版本和提示词缓存的beta头。
+    """
+    headers = (
+        ("Authorization", f"Bearer {api_key}"),
+        ("Content-Type", "application/json"),
+    )
+    if prompt_caching:
+        headers += (
+            ("anthropic-version", API_VERSION),
+            ("anthropic-beta", "prompt-caching-2024-07-31"),
+        )
+    return headers
+
+
+async def close_http_client():
+    """关闭共享的AsyncClient，在应用关闭时调用"""
+    global _client
+    if _client is not None and not _client.is_closed:
+        await _client.aclose()
+    _client = None
+
+
+async def read_error_text(response: httpx.Response, limit: int = 4096) -> str:
+    """读取错误响应体的前limit个字节，避免异常网关返回超大页面时占用过多内存"""
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes():
+        buffer.extend(chunk)
+        if len(buffer) >= limit:
+            break
+    return bytes(buffer[:limit]).decode("utf-8", errors="replace")
+
+
+def retry_backoff(retry_count: int) -> float:
+    """指数退避加完全抖动：min(上限, 0.5 * 2^n) * [0, 1)，避免多个请求同时重试"""
+    return min(MAX_RETRY_BACKOFF, 0.5 * (2 ** retry_count)) * random.random()
+
+
+def _openai_delta(data: dict) -> str:
+    """OpenAI兼容格式：choices[0].delta.content"""
+    choices = data.get("choices")
+    if not choices:
+        return ""
+    return choices[0].get("delta", {}).get("content") or ""
+
+
+def _anthropic_delta(data: dict) -> str:
+    """Anthropic格式：只有content_block_delta事件携带文本"""
+    if data.get("type") == "content_block_delta":
+        return data.get("delta", {}).get("text", "")
+    return ""
+
+
+def select_delta_extractor(data: dict) -> Callable[[dict], str]:
+    """根据第一个事件判断上游的响应格式，返回对应的增量提取函数
+
+    同一个上游接口的格式是固定的，判断一次后整个流都复用同一个提取函数。
+    """
+    return _anthropic_delta if "type" in data else _openai_delta
+
+
+async def iter_sse_data(response: httpx.Response) -> AsyncIterator[bytes]:
+    """按行解析SSE响应，产出每个data行的字节负载，收到[DONE]时结束
+
+    直接在字节上切分行，避免先整体解码为str；跨数据块的半行会保留到下一块拼接。
+    """
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes():
+        buffer.extend(chunk)
+        start = 0
+        while True:
+            newline = buffer.find(b"\n", start)
+            if newline == -1:
+                break
+            line = bytes(buffer[start:newline]).rstrip(b"\r")
+            start = newline + 1
+            if line.startswith(b"data: "):
+                payload = line[6:]
+                if payload == b"[DONE]":
+                    return
+                yield payload
+        del buffer[:start]
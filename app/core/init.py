@@ -1,5 +1,9 @@
-import os
+import logging
+import queue
+from pathlib import Path
+from logging.handlers import QueueHandler, QueueListener
 from app.core.config import (
+    DEBUG,
     MINIO_ENABLED,
     GENERATION_STATES_DIR,
     PARTIAL_CONTENTS_DIR,
@@ -7,12 +11,54 @@ from app.core.config import (
     IMAGES_DIR
 )
 
+# 日志后台监听器，负责在独立线程中输出日志
+_log_listener = None
+# 挂在根日志器上的QueueHandler，关闭日志时一并移除
+_log_queue_handler = None
+
+# 存储目录是否已创建，避免重复的mkdir系统调用
+_initialized = False
+
+def setup_logging():
+    """配置日志：通过QueueHandler将日志写入交给后台线程，避免阻塞事件循环"""
+    global _log_listener, _log_queue_handler
+    if _log_listener is not None:
+        return
+
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    _log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+
+    _log_queue_handler = QueueHandler(log_queue)
+    root_logger = logging.getLogger()
+    root_logger.addHandler(_log_queue_handler)
+    root_logger.setLevel(logging.INFO)
+    # DEBUG只作用于本应用的日志器，第三方库保持INFO，避免调试日志淹没输出
+    logging.getLogger("app").setLevel(logging.DEBUG if DEBUG else logging.INFO)
+    _log_listener.start()
+
+def shutdown_logging():
+    """停止日志后台监听器，输出队列中剩余的日志后移除QueueHandler"""
+    global _log_listener, _log_queue_handler
+    if _log_listener is None:
+        return
+
+    _log_listener.stop()
+    logging.getLogger().removeHandler(_log_queue_handler)
+    _log_listener = None
+    _log_queue_handler = None
+
 def create_storage_directories():
-    """创建应用所需的存储目录"""
-    os.makedirs(GENERATION_STATES_DIR, exist_ok=True)
-    os.makedirs(PARTIAL_CONTENTS_DIR, exist_ok=True)
-    os.makedirs(PDFS_DIR, exist_ok=True)  # PDF存储目录
-    os.makedirs(IMAGES_DIR, exist_ok=True)  # 图片存储目录
+    """创建应用所需的存储目录，重复调用时直接返回"""
+    global _initialized
+    if _initialized:
+        return
+
+    # PDF和图片目录需要在挂载静态文件服务前存在
+    for directory in (GENERATION_STATES_DIR, PARTIAL_CONTENTS_DIR, PDFS_DIR, IMAGES_DIR):
+        Path(directory).mkdir(parents=True, exist_ok=True)
+    _initialized = True
     print("已创建存储目录")
 
 def initialize_minio():
@@ -0,0 +1,42 @@
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class SSEGZipMiddleware:
+    """对text/event-stream响应做gzip压缩
+
+    每个数据块压缩后以Z_SYNC_FLUSH刷新，客户端收到的每一块都能立即解码，
+    不会像普通gzip那样把事件积压在压缩缓冲区里。其他响应原样透传。
+    """
+
+    def __init__(self, app: ASGIApp, compresslevel: int = 6) -> None:
+        self.app = app
+        self.compresslevel = compresslevel
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or "gzip" not in Headers(scope=scope).get("accept-encoding", ""):
+            await self.app(scope, receive, send)
+            return
+
+        compressor = None
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal compressor
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                if headers.get("content-type", "").startswith("text/event-stream") and "content-encoding" not in headers:
+                    # wbits=31 输出带gzip头的数据流
+                    compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED, 31)
+                    headers["Content-Encoding"] = "gzip"
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["content-length"]
+            elif message["type"] == "http.response.body" and compressor is not None:
+                more_body = message.get("more_body", False)
+                body = compressor.compress(message.get("body", b""))
+                body += compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+                message = {"type": "http.response.body", "body": body, "more_body": more_body}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -1,11 +1,20 @@
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import ORJSONResponse
 
 from app.api.stream_router import router as stream_router
-from app.core.config import APP_HOST, APP_PORT, DEBUG, MINIO_ENABLED
-from app.core.init import create_storage_directories, initialize_minio
+from app.core.config import APP_HOST, APP_PORT, DEBUG, MINIO_ENABLED, BLOCKING_IO_WORKERS
+from app.core.init import create_storage_directories, initialize_minio, setup_logging, shutdown_logging
+from app.core.http_client import close_http_client
+from app.core.sse_gzip import SSEGZipMiddleware
+from app.services.pdf_generation import shutdown_pdf_pool
+
+# 配置日志
+setup_logging()
 
 # 创建存储目录
 create_storage_directories()
@@ -15,7 +24,8 @@ app = FastAPI(
     title="剧本生成器 API",
     description="基于HTTP流式响应(SSE)的剧本生成服务",
     version="1.0.0",
-    openapi_extra={"x-server-timeout": 300}  # 5分钟超时
+    openapi_extra={"x-server-timeout": 300},  # 5分钟超时
+    default_response_class=ORJSONResponse  # 用orjson序列化JSON响应，大段剧本内容编码更快
 )
 
 # 添加CORS中间件
@@ -42,6 +52,9 @@ app.add_middleware(
     max_age=600,
 )
 
+# SSE响应gzip压缩，事件文本重复度高，逐块同步刷新保证实时性
+app.add_middleware(SSEGZipMiddleware, compresslevel=6)
+
 # 如果启用了MinIO，则不需要挂载本地静态文件服务
 if not MINIO_ENABLED:
     # 挂载静态文件服务
@@ -53,11 +66,22 @@ if not MINIO_ENABLED:
 # 挂载流式API路由
 app.include_router(stream_router, prefix="/api")
 
+# 应用启动时设置有界的默认线程池，asyncio.to_thread的阻塞I/O都在其中执行
+@app.on_event("startup")
+async def setup_default_executor():
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+    )
+
+# 应用关闭时释放共享HTTP连接池和PDF生成进程池，最后停止日志监听线程，确保关闭过程的日志都已输出
+@app.on_event("shutdown")
+async def shutdown_resources():
+    await close_http_client()
+    shutdown_pdf_pool()
+    shutdown_logging()
+
 # 直接运行时的入口点
 if __name__ == "__main__":
-    # 确保存储目录存在
-    create_storage_directories()
-    
     # 初始化MinIO客户端
     initialize_minio()
     
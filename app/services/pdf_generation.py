@@ -1,225 +1,392 @@
 import asyncio
+import functools
+import logging
+import multiprocessing
 import os
 import re
-from typing import Dict, Any, Optional
-from fastapi.responses import JSONResponse
+import threading
+import time
+import orjson
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi import status
 
 from app.utils.storage import load_generation_state
-from app.utils.text_utils import extract_scene_prompts as extract_prompts
-from app.utils.pdf_generator import create_script_pdf
+from app.utils.text_utils import extract_scene_prompts_cached as extract_prompts
+from app.utils.pdf_generator import create_script_pdf_sync
 from app.core.config import PDFS_DIR, IMAGES_DIR
-from app.services.task_queue import script_to_image_task_mapping
+from app.services.task_queue import SSE_HEADERS, script_to_image_task_mapping, format_sse_event
 
+logger = logging.getLogger(__name__)
 
-async def generate_script_pdf_path_service(task_id: str, timeout: int = 60) -> JSONResponse:
+# PDF生成进程池：排版、字体和图片处理都是CPU密集且同步执行的，放到子进程中不占用事件循环
+# 使用spawn启动子进程，避免fork时继承日志线程等持有的锁
+_pdf_pool: Optional[ProcessPoolExecutor] = None
+
+# 流式PDF生成的心跳间隔和总超时（秒），客户端持续收到进度事件，因此可以比JSON接口等待更久
+PDF_PROGRESS_INTERVAL = 5.0
+PDF_STREAM_TIMEOUT = 600
+
+# 带结尾分隔符的目录前缀，热路径上直接拼接字符串，省去os.path.join的规范化开销
+_IMAGES_DIR_PREFIX = os.path.join(IMAGES_DIR, "")
+_PDFS_DIR_PREFIX = os.path.join(PDFS_DIR, "")
+
+# 剧名匹配模式，剧名通常位于剧本开头
+_TITLE_RE = re.compile(r'剧名：《(.+?)》')
+
+# 剧名中不允许出现在文件名里的字符（路径分隔符、换行等），以及剧名在文件名中的最大长度
+_UNSAFE_TITLE_RE = re.compile(r'[^\w\u4e00-\u9fff\- ]')
+_MAX_TITLE_LENGTH = 80
+
+# 清除提示词中的#号，str.translate一次完成
+_HASH_STRIP = str.maketrans('', '', '#')
+
+# 图片目录解析缓存 {(剧本任务ID, 关联图片请求ID): 图片目录ID}
+# 只缓存找到的目录，图片可能稍后才下载完成；关联的图片请求变化时键随之变化
+_IMAGE_FOLDER_CACHE_SIZE = 1024
+_image_folder_cache: Dict[Tuple[str, Optional[str]], str] = {}
+# 解析函数在线程池中执行，修改缓存时加锁
+_image_folder_cache_lock = threading.Lock()
+
+# IMAGES_DIR下子目录名索引 (目录mtime, 子目录名)，增删子目录会改变目录mtime，此时才重新扫描
+_images_dir_index: Tuple[int, Tuple[str, ...]] = (-1, ())
+
+# 已存在PDF的stat结果缓存 {PDF路径: (mtime, size, 缓存时间)}，有效期内不再访问磁盘
+_PDF_STAT_TTL = 30.0
+_pdf_stat_cache: Dict[str, Tuple[float, int, float]] = {}
+
+# 正在生成的PDF {预期PDF路径: 进程池future}，同一文件的并发请求等待同一个生成任务，不重复生成
+_pdf_inflight: Dict[str, asyncio.Future] = {}
+
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    """获取PDF生成进程池，首次使用时创建"""
+    global _pdf_pool
+    if _pdf_pool is None:
+        _pdf_pool = ProcessPoolExecutor(
+            max_workers=os.cpu_count(),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return _pdf_pool
+
+
+def shutdown_pdf_pool():
+    """关闭PDF生成进程池，在应用关闭时调用"""
+    global _pdf_pool
+    if _pdf_pool is not None:
+        _pdf_pool.shutdown(wait=False, cancel_futures=True)
+        _pdf_pool = None
+
+
+def _sanitize_title(title: str) -> str:
+    """替换剧名中的不安全字符并截断，避免生成的PDF文件名含路径分隔符或超出文件名长度限制"""
+    return _UNSAFE_TITLE_RE.sub('_', title)[:_MAX_TITLE_LENGTH]
+
+
+def _image_dir_names() -> Tuple[str, ...]:
+    """返回IMAGES_DIR下的子目录名，目录未变化时直接使用上次扫描的结果"""
+    global _images_dir_index
+    mtime = os.stat(IMAGES_DIR).st_mtime_ns
+    cached_mtime, names = _images_dir_index
+    if mtime != cached_mtime:
+        # scandir直接使用目录项中的类型信息，不需要逐个stat
+        with os.scandir(IMAGES_DIR) as entries:
+            names = tuple(entry.name for entry in entries if entry.is_dir())
+        _images_dir_index = (mtime, names)
+    return names
+
+
+def _resolve_image_folder(task_id: str) -> Optional[str]:
+    """按三种策略查找剧本对应的图片目录，找到的结果会被缓存
+
+    关联的图片请求ID只读取一次，后续策略和缓存键都使用这个快照。
+    """
+    image_request_id = script_to_image_task_mapping.get(task_id)
+    cache_key = (task_id, image_request_id)
+    cached = _image_folder_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    image_folder_id = None
+    
+    # 策略1：首先检查对应剧本任务ID的图片目录是否存在
+    direct_image_path = _IMAGES_DIR_PREFIX + task_id
+    if os.path.isdir(direct_image_path):
+        logger.debug("找到直接匹配的图片目录: %s", task_id)
+        image_folder_id = task_id
+    else:
+        # 策略2：查找关联的图片请求ID
+        if image_request_id:
+            request_image_path = _IMAGES_DIR_PREFIX + image_request_id
+            if os.path.isdir(request_image_path):
+                logger.debug("找到关联图片目录: %s", image_request_id)
+                image_folder_id = image_request_id
+            else:
+                logger.debug("关联图片目录不存在: %s", request_image_path)
+        else:
+            logger.debug("未找到关联的图片请求ID")
+        
+        # 策略3：查找任何可能相关的目录
+        if not image_folder_id:
+            logger.debug("尝试查找包含任务ID部分内容的图片目录")
+            for dir_name in _image_dir_names():
+                if task_id in dir_name:
+                    logger.debug("找到相关目录: %s", dir_name)
+                    image_folder_id = dir_name
+                    break
+    
+    if image_folder_id:
+        with _image_folder_cache_lock:
+            if len(_image_folder_cache) >= _IMAGE_FOLDER_CACHE_SIZE:
+                # 淘汰最早加入的条目
+                _image_folder_cache.pop(next(iter(_image_folder_cache)), None)
+            _image_folder_cache[cache_key] = image_folder_id
+    return image_folder_id
+
+
+def _probe_existing_pdf(pdf_path: str) -> Optional[os.stat_result]:
+    """检查已存在的PDF是否完整：大小大于0且末尾1KB内包含%%EOF
+
+    文件不存在或不完整时返回None。子进程先写临时文件再替换到目标路径，不完整的文件只可能是旧版本遗留，
+    不在这里删除，重新生成时会被原子替换。
+    """
+    try:
+        pdf_stat = os.stat(pdf_path)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.warning("检查文件时出错，可能文件损坏: %s", e)
+        return None
+    
+    complete = False
+    if pdf_stat.st_size > 0:
+        try:
+            fd = os.open(pdf_path, os.O_RDONLY)
+            try:
+                tail = os.pread(fd, 1024, max(0, pdf_stat.st_size - 1024))
+            finally:
+                os.close(fd)
+            complete = b"%%EOF" in tail
+        except OSError as e:
+            logger.warning("读取文件末尾出错: %s", e)
+        if not complete:
+            logger.info("PDF文件不完整，需要重新生成: %s", pdf_path)
+    else:
+        logger.info("文件大小为0，需要重新生成: %s", pdf_path)
+    
+    return pdf_stat if complete else None
+
+
+def _forget_inflight(pdf_path: str, future: asyncio.Future):
+    """生成任务结束后移除登记；所有等待方都已超时时取走异常，避免未读取异常的警告"""
+    if _pdf_inflight.get(pdf_path) is future:
+        del _pdf_inflight[pdf_path]
+    if not future.cancelled() and future.exception() is not None:
+        logger.warning("PDF后台生成失败: %s, 错误: %s", pdf_path, future.exception())
+
+
+def _invalidate_pdf_caches(task_id: str, pdf_path: str):
+    """PDF生成失败时清除相关缓存，下次请求重新解析目录和检查文件"""
+    with _image_folder_cache_lock:
+        for key in [k for k in _image_folder_cache if k[0] == task_id]:
+            _image_folder_cache.pop(key, None)
+    _pdf_stat_cache.pop(pdf_path, None)
+
+
+def _pdf_success_response(pdf_path: str, file_size: int, message: str) -> ORJSONResponse:
+    """构建返回PDF路径信息的成功响应"""
+    # 从路径中提取文件名
+    filename = os.path.basename(pdf_path)
+    # 构建相对于API服务的相对路径（供前端使用）
+    relative_path = f"/storage/pdfs/{filename}"
+    
+    return ORJSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={
+            "status": "success",
+            "message": message,
+            "data": {
+                "filename": filename,
+                "path": relative_path,
+                "full_path": pdf_path,
+                "size": file_size
+            }
+        }
+    )
+
+
+def _pdf_error_response(status_code: int, message: str, data: Optional[Dict[str, Any]] = None) -> ORJSONResponse:
+    """构建PDF服务的错误响应"""
+    content = {"status": "error", "message": message}
+    if data is not None:
+        content["data"] = data
+    return ORJSONResponse(status_code=status_code, content=content)
+
+
+def _submit_pdf_generation(expected_pdf_path: str, final_image_id: str, script_content: str) -> asyncio.Future:
+    """提取图片数据并把PDF生成提交到进程池，登记为该路径正在进行的生成任务"""
+    # 获取图片数据，用于构建PDF内容 {episode: {scene: {prompt_idx: {prompt}}}}
+    episodes_data = defaultdict(lambda: defaultdict(dict))
+    
+    # 使用剧本内容提取需要的图片信息
+    try:
+        # 从剧本中提取集数和场景信息
+        prompts_dict = extract_prompts(script_content)
+        
+        # 构建图片数据结构，只有存在有效提示词的集和场次才会被创建
+        for episode, scenes in prompts_dict.items():
+            for scene, prompts in scenes.items():
+                for idx, prompt in enumerate(prompts):
+                    clean_prompt = prompt.translate(_HASH_STRIP).strip() if '#' in prompt else prompt.strip()
+                    if clean_prompt:
+                        episodes_data[episode][scene][str(idx)] = {"prompt": clean_prompt}
+    except Exception as e:
+        logger.warning("提取提示词数据时出错: %s", e)
+        # 出错时仍然继续，只是没有提示词信息
+    
+    future = asyncio.get_running_loop().run_in_executor(
+        _get_pdf_pool(),
+        functools.partial(
+            create_script_pdf_sync,
+            task_id=final_image_id,  # 使用确定的图片目录ID
+            script_content=script_content,
+            image_data={episode: dict(scenes) for episode, scenes in episodes_data.items()},
+            output_dir=PDFS_DIR,
+            filename=os.path.basename(expected_pdf_path),  # 写入路径与探测、缓存、在途登记使用同一路径
+            with_progress=True
+        )
+    )
+    _pdf_inflight[expected_pdf_path] = future
+    future.add_done_callback(functools.partial(_forget_inflight, expected_pdf_path))
+    return future
+
+
+async def generate_script_pdf_path_service(task_id: str, timeout: int = 60) -> ORJSONResponse:
     """生成剧本PDF文件并返回文件路径服务"""
     try:
-        print(f"开始处理PDF路径请求，剧本任务ID: {task_id}")
+        logger.info("开始处理PDF路径请求，剧本任务ID: %s", task_id)
         
-        # 加载剧本内容
-        script_state = load_generation_state(task_id)
+        # 加载剧本内容（可能读取本地文件或MinIO，放到线程中执行）
+        script_state = await asyncio.to_thread(load_generation_state, task_id)
         if not script_state:
-            return JSONResponse(
-                status_code=status.HTTP_404_NOT_FOUND,
-                content={"status": "error", "message": f"找不到任务ID: {task_id} 的剧本内容"}
-            )
+            return _pdf_error_response(status.HTTP_404_NOT_FOUND, f"找不到任务ID: {task_id} 的剧本内容")
         
         script_content = script_state.get("full_script", "")
         if not script_content:
-            return JSONResponse(
-                status_code=status.HTTP_404_NOT_FOUND,
-                content={"status": "error", "message": "剧本内容为空"}
-            )
-        
-        # 确定使用哪个图片目录
-        image_folder_id = None
+            return _pdf_error_response(status.HTTP_404_NOT_FOUND, "剧本内容为空")
         
-        # 策略1：首先检查对应剧本任务ID的图片目录是否存在
-        direct_image_path = os.path.join(IMAGES_DIR, task_id)
-        if os.path.exists(direct_image_path) and os.path.isdir(direct_image_path):
-            print(f"找到直接匹配的图片目录: {task_id}")
-            image_folder_id = task_id
-        else:
-            # 策略2：查找关联的图片请求ID
-            image_request_id = script_to_image_task_mapping.get(task_id)
-            if image_request_id:
-                request_image_path = os.path.join(IMAGES_DIR, image_request_id)
-                if os.path.exists(request_image_path) and os.path.isdir(request_image_path):
-                    print(f"找到关联图片目录: {image_request_id}")
-                    image_folder_id = image_request_id
-                else:
-                    print(f"关联图片目录不存在: {request_image_path}")
-            else:
-                print(f"未找到关联的图片请求ID")
-            
-            # 策略3：查找任何可能相关的目录
-            if not image_folder_id:
-                print(f"尝试查找包含任务ID部分内容的图片目录")
-                for dir_name in os.listdir(IMAGES_DIR):
-                    dir_path = os.path.join(IMAGES_DIR, dir_name)
-                    if os.path.isdir(dir_path) and task_id in dir_name:
-                        print(f"找到相关目录: {dir_name}")
-                        image_folder_id = dir_name
-                        break
+        # 确定使用哪个图片目录（目录扫描放到线程中执行，不阻塞事件循环）
+        image_folder_id = await asyncio.to_thread(_resolve_image_folder, task_id)
         
         # 如果找到了图片目录，使用该目录；否则使用剧本任务ID（即使目录不存在）
         final_image_id = image_folder_id if image_folder_id else task_id
-        print(f"最终使用的图片目录ID: {final_image_id}")
+        logger.debug("最终使用的图片目录ID: %s", final_image_id)
         
         # 提取剧名，用于生成文件名
-        title_match = re.search(r'剧名：《(.+?)》', script_content)
-        title = title_match.group(1) if title_match else "未命名剧本"
+        # 先只在开头512个字符内查找，找不到时再搜索全文
+        title_match = _TITLE_RE.search(script_content, 0, 512) or _TITLE_RE.search(script_content)
+        title = _sanitize_title(title_match.group(1)) if title_match else "未命名剧本"
         
         # 构建预期的PDF文件路径
         expected_pdf_filename = f"{title}_{final_image_id}.pdf"
-        expected_pdf_path = os.path.join(PDFS_DIR, expected_pdf_filename)
+        expected_pdf_path = _PDFS_DIR_PREFIX + expected_pdf_filename
         
-        # 检查文件是否已存在
-        if os.path.exists(expected_pdf_path):
-            print(f"PDF文件已存在，直接返回路径: {expected_pdf_path}")
-            # 检查文件是否完整
-            try:
-                with open(expected_pdf_path, 'rb') as f:
-                    # 检查文件大小是否大于0，并尝试读取文件末尾以确保文件完整
-                    f.seek(0, 2)  # 移动到文件末尾
-                    file_size = f.tell()
-                    if file_size > 0:
-                        # 从路径中提取文件名
-                        filename = os.path.basename(expected_pdf_path)
-                        # 构建相对路径
-                        relative_path = f"/storage/pdfs/{filename}"
-                        
-                        # 返回文件路径信息
-                        return JSONResponse(
-                            status_code=status.HTTP_200_OK,
-                            content={
-                                "status": "success",
-                                "message": "PDF文件已存在",
-                                "data": {
-                                    "filename": filename,
-                                    "path": relative_path,
-                                    "full_path": expected_pdf_path,
-                                    "size": file_size
-                                }
-                            }
-                        )
-                    else:
-                        print(f"文件大小为0，需要重新生成: {expected_pdf_path}")
-                        # 删除零字节文件
-                        os.remove(expected_pdf_path)
-            except Exception as e:
-                print(f"检查文件时出错，可能文件损坏: {str(e)}")
-                # 尝试删除可能损坏的文件
-                try:
-                    os.remove(expected_pdf_path)
-                    print(f"已删除可能损坏的文件: {expected_pdf_path}")
-                except:
-                    pass
+        # 最近确认过的PDF直接返回，不再访问磁盘
+        cached_stat = _pdf_stat_cache.get(expected_pdf_path)
+        if cached_stat and time.monotonic() - cached_stat[2] < _PDF_STAT_TTL:
+            logger.info("PDF文件已存在（缓存），直接返回路径: %s", expected_pdf_path)
+            return _pdf_success_response(expected_pdf_path, cached_stat[1], "PDF文件已存在")
         
-        print(f"PDF文件不存在，需要生成: {expected_pdf_path}")
+        # 同一文件正在生成时等待已有任务，不检查也不重复生成
+        future = _pdf_inflight.get(expected_pdf_path)
         
-        # 获取图片数据，用于构建PDF内容
-        image_data = {"episodes": {}}
+        # 检查文件是否已存在且完整
+        pdf_stat = None if future is not None else await asyncio.to_thread(_probe_existing_pdf, expected_pdf_path)
+        if pdf_stat is not None:
+            logger.info("PDF文件已存在，直接返回路径: %s", expected_pdf_path)
+            _pdf_stat_cache[expected_pdf_path] = (pdf_stat.st_mtime, pdf_stat.st_size, time.monotonic())
+            return _pdf_success_response(expected_pdf_path, pdf_stat.st_size, "PDF文件已存在")
         
-        # 使用剧本内容提取需要的图片信息
-        try:
-            # 从剧本中提取集数和场景信息
-            prompts_dict = extract_prompts(script_content)
-            
-            # 构建图片数据结构
-            for episode, scenes in prompts_dict.items():
-                if episode not in image_data["episodes"]:
-                    image_data["episodes"][episode] = {}
-                
-                for scene, prompts in scenes.items():
-                    if scene not in image_data["episodes"][episode]:
-                        image_data["episodes"][episode][scene] = {}
-                    
-                    for idx, prompt in enumerate(prompts):
-                        clean_prompt = prompt.replace('#', '').strip()
-                        if clean_prompt:
-                            image_data["episodes"][episode][scene][str(idx)] = {
-                                "prompt": clean_prompt
-                            }
-        except Exception as e:
-            print(f"提取提示词数据时出错: {str(e)}")
-            # 出错时仍然继续，只是没有提示词信息
+        if future is not None:
+            logger.info("PDF正在生成中，等待已有的生成任务: %s", expected_pdf_path)
+        else:
+            logger.info("PDF文件不存在，需要生成: %s", expected_pdf_path)
+            future = _submit_pdf_generation(expected_pdf_path, final_image_id, script_content)
         
         # 使用异步任务和超时机制生成PDF
         try:
-            # 创建任务，并设置超时
-            pdf_path_future = asyncio.create_task(
-                create_script_pdf(
-                    task_id=final_image_id,  # 使用确定的图片目录ID
-                    script_content=script_content,
-                    image_data=image_data["episodes"],
-                    output_dir=PDFS_DIR,
-                    with_progress=True
-                )
-            )
+            # shield保证等待方超时不会取消生成任务；子进程会继续完成，其他请求可以继续等待或直接复用生成的文件
+            pdf_path = await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
             
-            # 等待任务完成，增加超时处理
-            pdf_path = await asyncio.wait_for(pdf_path_future, timeout=timeout)
-            
-            print(f"PDF生成成功，文件路径: {pdf_path}")
+            logger.info("PDF生成成功，文件路径: %s", pdf_path)
             
             # 检查pdf_path是否为None
             if pdf_path is None:
-                return JSONResponse(
-                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                    content={
-                        "status": "error", 
-                        "message": "PDF生成失败：无法获取有效的文件路径"
-                    }
-                )
-            
-            # 从路径中提取文件名
-            filename = os.path.basename(pdf_path)
+                _invalidate_pdf_caches(task_id, expected_pdf_path)
+                return _pdf_error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, "PDF生成失败：无法获取有效的文件路径")
             
-            # 构建相对于API服务的相对路径（供前端使用）
-            relative_path = f"/storage/pdfs/{filename}"
-            
-            # 获取文件大小
-            file_size = os.path.getsize(pdf_path) if os.path.exists(pdf_path) else 0
+            # 获取文件大小，并记录到stat缓存；上传到MinIO时返回的是URL，本地没有文件可查
+            file_size = 0
+            if not pdf_path.startswith(("http://", "https://")):
+                try:
+                    pdf_stat = os.stat(pdf_path)
+                    file_size = pdf_stat.st_size
+                    _pdf_stat_cache[expected_pdf_path] = (pdf_stat.st_mtime, file_size, time.monotonic())
+                except OSError:
+                    pass
             
             # 返回文件路径信息
-            return JSONResponse(
-                status_code=status.HTTP_200_OK,
-                content={
-                    "status": "success",
-                    "message": "PDF生成成功",
-                    "data": {
-                        "filename": filename,
-                        "path": relative_path,
-                        "full_path": pdf_path,
-                        "size": file_size
-                    }
-                }
-            )
+            return _pdf_success_response(pdf_path, file_size, "PDF生成成功")
         except asyncio.TimeoutError:
-            print(f"PDF生成超时 (超过{timeout}秒)")
-            return JSONResponse(
-                status_code=status.HTTP_408_REQUEST_TIMEOUT,
-                content={
-                    "status": "error",
-                    "message": f"PDF生成超时 (超过{timeout}秒)，请稍后再试",
-                    "data": {
-                        "expected_path": expected_pdf_path
-                    }
-                }
+            logger.warning("PDF生成超时 (超过%d秒)", timeout)
+            _invalidate_pdf_caches(task_id, expected_pdf_path)
+            return _pdf_error_response(
+                status.HTTP_408_REQUEST_TIMEOUT,
+                f"PDF生成超时 (超过{timeout}秒)，请稍后再试",
+                {"expected_path": expected_pdf_path}
             )
         
     except Exception as e:
         # 输出详细错误信息以便调试
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"PDF生成出错 (path模式): {str(e)}\n{error_details}")
-        
-        return JSONResponse(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            content={
-                "status": "error", 
-                "message": f"生成PDF出错: {str(e)}"
-            }
-        ) 
\ No newline at end of file
+        logger.exception("PDF生成出错 (path模式): %s", e)
+        
+        return _pdf_error_response(status.HTTP_500_INTERNAL_SERVER_ERROR, f"生成PDF出错: {str(e)}") 
+
+
+async def stream_script_pdf_service(task_id: str) -> StreamingResponse:
+    """流式生成剧本PDF：生成期间定期推送进度事件，完成后推送结果，避免客户端长时间无响应而超时重试"""
+    
+    async def event_generator():
+        yield format_sse_event("status", {"message": "正在生成PDF...", "task_id": task_id})
+        
+        start_time = time.monotonic()
+        pdf_task = asyncio.create_task(generate_script_pdf_path_service(task_id, timeout=PDF_STREAM_TIMEOUT))
+        try:
+            while True:
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(pdf_task), timeout=PDF_PROGRESS_INTERVAL)
+                    break
+                except asyncio.TimeoutError:
+                    yield format_sse_event("progress", {
+                        "message": "PDF生成中...",
+                        "elapsed": int(time.monotonic() - start_time)
+                    })
+            
+            # 复用JSON接口的响应内容
+            content = orjson.loads(response.body)
+            if response.status_code == status.HTTP_200_OK:
+                yield format_sse_event("complete", content)
+            else:
+                yield format_sse_event("error", content)
+        finally:
+            # 客户端断开时不再等待结果；进程池中的生成会继续完成，之后的请求可直接复用文件
+            if not pdf_task.done():
+                pdf_task.cancel()
+    
+    return StreamingResponse(
+        event_generator(),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
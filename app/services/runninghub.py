@@ -1,10 +1,12 @@
 import asyncio
+import logging
 import uuid
 import time
-import json
 import re
-from typing import Dict, Any, List, Optional, Set
-from fastapi.responses import StreamingResponse, JSONResponse
+from collections import Counter
+import orjson
+from typing import Dict, Any, List, Optional, Set, Tuple
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from fastapi import status
 
 from app.api.models import (
@@ -12,8 +14,8 @@ from app.api.models import (
     RunningHubTaskStatusRequest,
     RunningHubTaskResultRequest
 )
-from app.utils.storage import load_generation_state
-from app.utils.text_utils import extract_scene_prompts as extract_prompts
+from app.utils.storage import load_generation_state, load_generation_prompts
+from app.utils.text_utils import scene_sort_key
 from app.utils.runninghub_api import (
     query_task_status,
     query_task_result,
@@ -21,18 +23,74 @@ from app.utils.runninghub_api import (
     cancelled_task_ids
 )
 from app.services.task_queue import (
+    EVENT_PUT_TIMEOUT,
+    EVENT_QUEUE_MAXSIZE,
+    SSE_HEADERS,
+    emit_event,
     format_sse_event,
     global_event_queues,
     global_task_queue,
     global_tasks_status,
     global_request_metadata,
     global_runninghub_tasks,
+    global_request_subtasks,
+    update_task_status,
     script_to_image_task_mapping,
+    image_to_script_task_mapping,
+    slow_clients,
     ensure_global_worker_running,
     active_streaming_tasks
 )
 from app.services.image_processing import download_and_report_images
 
+logger = logging.getLogger(__name__)
+
+# 单次合并发送的SSE事件最大字节数，突发的子任务事件一次写出而不是逐条发送
+SSE_BATCH_MAX_BYTES = 8192
+
+# 没有任何事件时的心跳间隔（秒），任务完成和图片下载结束都会主动唤醒事件循环，不依赖轮询
+SSE_KEEPALIVE_INTERVAL = 15.0
+
+# 结束事件流相关的事件名
+_TERMINAL_EVENTS = frozenset({"complete", "cancel_complete", "all_tasks_completed"})
+
+# 清除提示词中的#号，str.translate一次完成
+_HASH_STRIP = str.maketrans('', '', '#')
+
+# 客户端断开后后台执行的取消任务，持有强引用防止任务在完成前被垃圾回收
+_background_cancel_tasks: Set[asyncio.Task] = set()
+
+
+def _on_background_cancel_done(task: asyncio.Task):
+    """后台取消任务结束时移出集合，并记录失败原因"""
+    _background_cancel_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("断开连接后取消RunningHub任务失败: %s", task.exception(), exc_info=task.exception())
+
+
+def _preprocess_prompts(prompts_dict: Dict[Any, Dict[str, List[str]]]) -> List[Tuple[Any, str, str, str, int, str]]:
+    """将提取的画面描述词展开为按场次排序的任务列表
+    
+    每个提示词只清理一次，集数和场次的显示键每集/每场只格式化一次，空提示词被过滤。
+    
+    Returns:
+        [(集数, 集数键, 场次, 场次键, 提示词索引, 清理后的提示词), ...]
+    """
+    flat_prompts = []
+    for episode, scenes in prompts_dict.items():
+        # 格式化集数键为"第X集"
+        episode_key = f"第{episode}集" if not str(episode).startswith("第") else str(episode)
+        
+        # 按场次编号排序，确保按照顺序处理
+        for scene in sorted(scenes, key=scene_sort_key):
+            # 格式化场景键为"场次X-X"
+            scene_key = f"场次{scene}" if not str(scene).startswith("场次") else str(scene)
+            for idx, prompt in enumerate(scenes[scene]):
+                clean_prompt = prompt.translate(_HASH_STRIP).strip()
+                if clean_prompt:
+                    flat_prompts.append((episode, episode_key, scene, scene_key, idx, clean_prompt))
+    return flat_prompts
+
 
 async def process_prompts_service(request: RunningHubProcessRequest) -> StreamingResponse:
     """将剧本中提取的画面描述词发送到RunningHub API处理"""
@@ -45,7 +103,7 @@ async def process_prompts_service(request: RunningHubProcessRequest) -> Streamin
     # 检查存储中是否有对应剧本
     state = load_generation_state(script_task_id)
     if not state:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_404_NOT_FOUND,
             content={"detail": f"未找到任务ID {script_task_id} 的剧本"}
         )
@@ -54,40 +112,30 @@ async def process_prompts_service(request: RunningHubProcessRequest) -> Streamin
         try:
             # 生成唯一的请求ID
             request_id = str(uuid.uuid4())
-            print(f"创建请求: {request_id}, 剧本ID: {script_task_id}")
+            logger.info("创建请求: %s, 剧本ID: %s", request_id, script_task_id)
             
             # 保存剧本任务ID和图片请求ID的映射关系
             script_to_image_task_mapping[script_task_id] = request_id
-            print(f"已创建任务映射: 剧本任务 {script_task_id} -> 图片请求 {request_id}")
+            image_to_script_task_mapping[request_id] = script_task_id
+            logger.debug("已创建任务映射: 剧本任务 %s -> 图片请求 %s", script_task_id, request_id)
             
             # 创建事件队列并注册到全局字典
-            event_queue = asyncio.Queue()
+            event_queue = asyncio.Queue(maxsize=EVENT_QUEUE_MAXSIZE)
             global_event_queues[request_id] = event_queue
             
             # 发送开始事件
             yield format_sse_event("status", {"message": "正在提取画面描述词并发送到RunningHub...", "request_id": request_id})
             
             # 提取画面描述词
-            script_text = state.get("full_script", "")
             try:
-                prompts_dict = extract_prompts(script_text)
+                prompts_dict = load_generation_prompts(script_task_id) or {}
                 
-                # 打印详细提取信息
-                print(f"提取到的画面描述词详情:")
+                # 打印提取信息，每个提示词的详情在入队时打印
+                logger.info("提取到的画面描述词详情:")
                 for episode, scenes in prompts_dict.items():
-                    scene_count = len(scenes)
-                    prompt_count = sum(len([p for p in prompts if p.replace('#', '').strip()]) for _, prompts in scenes.items())
-                    print(f"  第{episode}集: {scene_count}个场景, {prompt_count}个提示词")
-                    # 添加更详细的场次信息
-                    for scene, prompts in scenes.items():
-                        print(f"    场次{scene}: {len(prompts)}个提示词")
-                        for i, prompt in enumerate(prompts):
-                            clean_prompt = prompt.replace('#', '').strip()
-                            print(f"      [{i}] {clean_prompt[:50]}..." if len(clean_prompt) > 50 else f"      [{i}] {clean_prompt}")
+                    logger.info("第%s集: %s个场景, %s个提示词", episode, len(scenes), sum(len(prompts) for prompts in scenes.values()))
             except Exception as e:
-                print(f"提取画面描述词时出错: {str(e)}")
-                import traceback
-                print(traceback.format_exc())
+                logger.exception("提取画面描述词时出错: %s", e)
                 yield format_sse_event("error", {"message": f"提取画面描述词时出错: {str(e)}"})
                 return
             
@@ -97,9 +145,9 @@ async def process_prompts_service(request: RunningHubProcessRequest) -> Streamin
                 if specific_episode in prompts_dict:
                     single_episode_dict = {specific_episode: prompts_dict[specific_episode]}
                     prompts_dict = single_episode_dict
-                    print(f"只处理第{specific_episode}集的画面描述词")
+                    logger.info("只处理第%s集的画面描述词", specific_episode)
                 else:
-                    print(f"错误: 未找到第{specific_episode}集的画面描述词")
+                    logger.warning("未找到第%s集的画面描述词", specific_episode)
                     yield format_sse_event("error", {"message": f"未找到第{specific_episode}集的画面描述词"})
                     return
             
@@ -107,66 +155,62 @@ async def process_prompts_service(request: RunningHubProcessRequest) -> Streamin
             total_tasks = 0
             request_task_ids = []  # 存储此请求的所有任务ID
             
+            # 入队前创建请求元数据，任务状态变化时update_task_status会同步更新其中的状态计数
+            global_request_metadata[request_id] = {
+                "total_tasks": 0,
+                "task_ids": request_task_ids,
+                "status_counts": Counter(),
+                "done_event": asyncio.Event(),  # 所有子任务结束时由update_task_status置位
+                "dropped_events": 0,  # 队列满时被丢弃的事件数，由emit_event累计
+                "created_time": time.time()
+            }
+            
             # 将任务添加到全局队列
-            for episode, scenes in prompts_dict.items():
-                # 格式化集数键为"第X集"
-                episode_key = f"第{episode}集" if not str(episode).startswith("第") else str(episode)
+            for episode, episode_key, scene, scene_key, idx, clean_prompt in _preprocess_prompts(prompts_dict):
+                total_tasks += 1
+                # 准备任务数据
+                task_data = {
+                    "episode": episode,
+                    "episode_key": episode_key,
+                    "scene": scene,
+                    "scene_key": scene_key,
+                    "prompt_index": idx,
+                    "prompt": clean_prompt
+                }
                 
-                print(f"\n开始添加第{episode}集的任务到队列:")
+                # 生成一个独特的任务ID
+                # 使用确定的格式：请求ID_集数_场景_提示词索引
+                subtask_id = f"{request_id}_{episode}_{scene}_{idx}"
+                request_task_ids.append(subtask_id)
                 
-                # 按场次编号排序，确保按照顺序处理
-                sorted_scenes = sorted(scenes.keys(), key=lambda x: tuple(map(int, x.split('-'))))
-                for scene in sorted_scenes:
-                    # 格式化场景键为"场次X-X"
-                    scene_key = f"场次{scene}" if not str(scene).startswith("场次") else str(scene)
-                    
-                    print(f"  处理场次{scene}的提示词:")
-                    prompts = scenes[scene]
-                    
-                    # 添加有效提示词到队列
-                    for idx, prompt in enumerate(prompts):
-                        clean_prompt = prompt.replace('#', '').strip()
-                        if clean_prompt:
-                            total_tasks += 1
-                            # 准备任务数据
-                            task_data = {
-                                "episode": episode,
-                                "episode_key": episode_key,
-                                "scene": scene,
-                                "scene_key": scene_key,
-                                "prompt_index": idx,
-                                "prompt": clean_prompt
-                            }
-                            
-                            # 生成一个独特的任务ID
-                            # 使用确定的格式：请求ID_集数_场景_提示词索引
-                            subtask_id = f"{request_id}_{episode}_{scene}_{idx}"
-                            request_task_ids.append(subtask_id)
-                            
-                            print(f"    添加任务: {subtask_id} - 提示词: {clean_prompt[:50]}..." if len(clean_prompt) > 50 else f"    添加任务: {subtask_id} - 提示词: {clean_prompt}")
-                            
-                            # 创建全局任务项
-                            task_item = {
-                                "request_id": request_id,
-                                "task_data": task_data,
-                                "added_time": time.time(),
-                                "subtask_id": subtask_id  # 任务ID字段
-                            }
-                            
-                            # 添加到全局队列
-                            await global_task_queue.put(task_item)
-                            
-                            # 更新状态跟踪
-                            global_tasks_status[subtask_id] = {
-                                "status": "QUEUED",
-                                "queue_time": time.time(),
-                                "request_id": request_id,
-                                "task_data": task_data
-                            }
+                logger.debug("添加任务: %s - 提示词: %.50s", subtask_id, clean_prompt)
+                
+                # 创建全局任务项
+                task_item = {
+                    "request_id": request_id,
+                    "task_data": task_data,
+                    "added_time": time.time(),
+                    "subtask_id": subtask_id  # 任务ID字段
+                }
+                
+                # 添加到全局队列（无界队列，put_nowait不会失败；整批入队期间不让出事件循环）
+                global_task_queue.put_nowait(task_item)
+                
+                # 更新状态跟踪
+                update_task_status(subtask_id, {
+                    "status": "QUEUED",
+                    "queue_time": time.time(),
+                    "request_id": request_id,
+                    "task_data": task_data
+                })
+            
+            global_request_metadata[request_id]["total_tasks"] = total_tasks
+            if total_tasks == 0:
+                global_request_metadata[request_id]["done_event"].set()
             
             # 打印任务详情
-            print(f"请求 {request_id} 添加了 {total_tasks} 个任务")
-            print(f"任务ID列表: {request_task_ids}")
+            logger.info("请求 %s 添加了 %s 个任务", request_id, total_tasks)
+            logger.debug("任务ID列表: %s", request_task_ids)
             
             # 确保全局工作器在运行
             ensure_global_worker_running()
@@ -183,143 +227,163 @@ async def process_prompts_service(request: RunningHubProcessRequest) -> Streamin
             if request_id not in global_event_queues:
                 global_event_queues[request_id] = event_queue
             
-            # 创建请求元数据存储
-            global_request_metadata[request_id] = {
-                "total_tasks": total_tasks,
-                "task_ids": request_task_ids,
-                "created_time": time.time()
-            }
-            
             # 从事件队列读取并yield事件
             try:
                 # 设置是否已发送完成事件的标志
                 complete_sent = False
-                download_tasks = []
+                # 客户端断开连接后生成器被取消，不能再产出事件
+                client_disconnected = False
+                
+                # 尚未结束的图片下载任务，任务结束时由回调移除；全部结束时置位downloads_done唤醒主循环
+                pending_downloads = set()
+                downloads_done = asyncio.Event()
+                downloads_waiter = None
+                get_task = None
+                # 请求的所有子任务结束时完成，唤醒主循环检查是否可以发送complete事件
+                request_done_waiter = asyncio.create_task(global_request_metadata[request_id]["done_event"].wait())
+                
+                def on_download_done(task):
+                    pending_downloads.discard(task)
+                    if not pending_downloads:
+                        downloads_done.set()
                 
                 while True:
                     try:
-                        # 等待事件，较短的超时确保响应性
-                        event = await asyncio.wait_for(event_queue.get(), timeout=0.5)
-                        yield event
-                        event_queue.task_done()
+                        # 等待事件、所有子任务结束或图片下载全部结束，长时间空闲时发送心跳
+                        if get_task is None:
+                            get_task = asyncio.create_task(event_queue.get())
+                        waiters = {get_task}
+                        if request_done_waiter is not None:
+                            waiters.add(request_done_waiter)
+                        if pending_downloads:
+                            if downloads_waiter is None:
+                                downloads_waiter = asyncio.create_task(downloads_done.wait())
+                            waiters.add(downloads_waiter)
+                        
+                        done, _ = await asyncio.wait(waiters, timeout=SSE_KEEPALIVE_INTERVAL, return_when=asyncio.FIRST_COMPLETED)
+                        if downloads_waiter is not None and downloads_waiter.done():
+                            downloads_waiter = None
+                        if request_done_waiter is not None and request_done_waiter.done():
+                            request_done_waiter = None
+                        if get_task not in done:
+                            if not done:
+                                # SSE注释行作为心跳，防止代理因长时间空闲断开连接
+                                yield b": keepalive\n\n"
+                            # 子任务或图片下载全部结束（或心跳超时），转入下方的进度检查
+                            raise asyncio.TimeoutError
+                        event = get_task.result()
+                        get_task = None
+                        
+                        # 一并取出队列中已积压的事件，合并为一次写出，减少突发时的发送次数
+                        batch = [event]
+                        batch_bytes = len(event)
+                        while batch_bytes < SSE_BATCH_MAX_BYTES:
+                            try:
+                                next_event = event_queue.get_nowait()
+                            except asyncio.QueueEmpty:
+                                break
+                            batch.append(next_event)
+                            batch_bytes += len(next_event)
                         
-                        # 检查是否是complete事件或cancel_complete事件，注意避免混淆task_completed与complete事件
-                        if (("event: complete" in event) or 
-                            ("event: cancel_complete" in event) or 
-                            ("event: all_tasks_completed" in event)):  # 确保完全匹配事件名称
+                        output = []
+                        stream_finished = False
+                        for event in batch:
+                            output.append(event)
+                            event_queue.task_done()
+                            
+                            # 事件名位于第一行"event: 名称"，取出一次后按名称精确比较
+                            event_name = event[7:event.find(b"\n")].decode() if event.startswith(b"event: ") else ""
                             
-                            # 标记已发送完成事件
-                            if not complete_sent:
-                                print(f"收到完成或取消事件，准备结束事件流: {event}")
+                            # 检查是否是complete事件或cancel_complete事件，注意避免混淆task_completed与complete事件
+                            if event_name in _TERMINAL_EVENTS:
                                 
-                                # 如果收到的是取消事件，确保发送complete事件
-                                if "event: cancel_complete" in event and "event: complete" not in event:
-                                    yield format_sse_event("complete", {
-                                        "message": "所有任务处理完成(已取消)",
-                                        "request_id": request_id
-                                    })
-
-                                # 如果接收到all_tasks_completed但没有收到complete
-                                if "event: all_tasks_completed" in event and "event: complete" not in event:
-                                    # 检查所有图片下载任务是否完成
-                                    all_downloads_done = True
-                                    if download_tasks:
-                                        print(f"检查{len(download_tasks)}个图片下载任务状态...")
-                                        # 检查是否所有下载任务都已完成
-                                        for dt in download_tasks:
-                                            if not dt.done():
-                                                all_downloads_done = False
-                                                print(f"等待图片下载任务完成...")
-                                                # 继续等待，不立即发送complete事件
-                                                break
+                                # 标记已发送完成事件
+                                if not complete_sent:
+                                    logger.debug("收到完成或取消事件，准备结束事件流: %s", event)
                                     
-                                    if all_downloads_done:
-                                        print(f"所有图片下载任务已完成，发送complete事件")
-                                        yield format_sse_event("complete", {
-                                            "message": "所有任务和图片下载处理完成",
-                                            "request_id": request_id
-                                        })
+                                    # 如果收到的是取消事件，确保发送complete事件；取消服务发出的队列项已带有complete帧
+                                    if event_name == "cancel_complete":
+                                        if b"\n\nevent: complete\n" not in event:
+                                            output.append(format_sse_event("complete", {
+                                                "message": "所有任务处理完成(已取消)",
+                                                "request_id": request_id
+                                            }))
                                         complete_sent = True
+                                        stream_finished = True
+                                        break
+                                    
+                                    # 如果接收到all_tasks_completed，下载也都结束时发送complete事件
+                                    elif event_name == "all_tasks_completed":
+                                        # 检查所有图片下载任务是否完成
+                                        if pending_downloads:
+                                            # 继续等待，不立即发送complete事件；最后一个下载结束时会唤醒主循环
+                                            logger.debug("等待%s个图片下载任务完成...", len(pending_downloads))
+                                        else:
+                                            logger.debug("所有图片下载任务已完成，发送complete事件")
+                                            output.append(format_sse_event("complete", {
+                                                "message": "所有任务和图片下载处理完成",
+                                                "request_id": request_id
+                                            }))
+                                            complete_sent = True
                                 
-                                if "event: complete" not in event and "event: all_tasks_completed" not in event:
-                                    complete_sent = True
+                                # 如果是complete事件，准备结束循环
+                                if event_name == "complete":
+                                    stream_finished = True
+                                    break
                             
-                            # 如果是complete事件，准备结束循环
-                            if "event: complete" in event:
-                                # 等待一小段时间确保所有事件都被处理
-                                await asyncio.sleep(1)
-                                print(f"收到complete事件，结束事件流")
-                                break
+                            # 检查是否是subtask_completed事件，如果是并且自动下载设置为True，则下载图片
+                            if auto_download and event_name == "subtask_completed":
+                                try:
+                                    # 解析事件数据：partition只切分一次，orjson直接解析data部分
+                                    event_data = orjson.loads(event.partition(b"data: ")[2])
+                                    logger.debug("收到子任务完成事件，正在处理图片下载: %s", event_data.get('task_id'))
+                                    
+                                    # 异步下载图片，不阻塞主流程
+                                    download_task = asyncio.create_task(
+                                        download_and_report_images(event_data, event_queue)
+                                    )
+                                    
+                                    # 将下载任务添加到跟踪集合，结束时自动移除
+                                    pending_downloads.add(download_task)
+                                    downloads_done.clear()
+                                    download_task.add_done_callback(on_download_done)
+                                    
+                                except Exception as e:
+                                    logger.error("处理下载图片时出错: %s", e)
                         
-                        # 检查是否是subtask_completed事件，如果是并且自动下载设置为True，则下载图片
-                        if auto_download and "event: subtask_completed" in event:
-                            try:
-                                # 解析事件数据
-                                event_data = json.loads(event.split("data: ")[1])
-                                print(f"收到子任务完成事件，正在处理图片下载: {event_data.get('task_id')}")
-                                
-                                # 异步下载图片，不阻塞主流程
-                                download_task = asyncio.create_task(
-                                    download_and_report_images(event_data, event_queue)
-                                )
-                                
-                                # 将下载任务添加到跟踪列表
-                                download_tasks.append(download_task)
-                                
-                            except Exception as e:
-                                print(f"处理下载图片时出错: {str(e)}")
+                        yield b"".join(output)
+                        
+                        if stream_finished:
+                            # 等待一小段时间确保所有事件都被处理
+                            await asyncio.sleep(1)
+                            logger.info("收到complete事件，结束事件流")
+                            break
                         
                     except asyncio.TimeoutError:
                         # 检查请求的任务进度
                         if request_id in global_request_metadata:
-                            # 从元数据中获取请求的总任务数和任务ID列表
+                            # 从元数据中获取请求的总任务数和状态计数，计数由工作协程在状态变化时维护
                             request_meta = global_request_metadata[request_id]
                             expected_total = request_meta["total_tasks"]
-                            request_task_ids = request_meta["task_ids"]
-                            
-                            # 根据任务ID列表检查完成状态
-                            completed_tasks = []
-                            for subtask_id in request_task_ids:
-                                if subtask_id in global_tasks_status:
-                                    task_status = global_tasks_status[subtask_id]
-                                    if task_status["status"] in ["COMPLETED", "ERROR"]:
-                                        completed_tasks.append(subtask_id)
-                            
-                            # 计算队列中和处理中的任务
-                            queued_tasks = []
-                            processing_tasks = []
-                            for subtask_id in request_task_ids:
-                                if subtask_id in global_tasks_status:
-                                    status = global_tasks_status[subtask_id]["status"]
-                                    if status == "QUEUED":
-                                        queued_tasks.append(subtask_id)
-                                    elif status == "PROCESSING":
-                                        processing_tasks.append(subtask_id)
+                            status_counts = request_meta["status_counts"]
+                            completed_count = status_counts["COMPLETED"] + status_counts["ERROR"]
                             
                             # 打印详细状态
-                            print(f"请求 {request_id} 任务状态: 完成={len(completed_tasks)}/{expected_total}, "
-                                  f"队列中={len(queued_tasks)}, 处理中={len(processing_tasks)}, "
-                                  f"全局队列大小={global_task_queue.qsize()}")
+                            logger.debug("请求 %s 任务状态: 完成=%s/%s, 队列中=%s, 处理中=%s, 全局队列大小=%s", request_id, completed_count, expected_total, status_counts['QUEUED'], status_counts['PROCESSING'], global_task_queue.qsize())
                             
                             # 判断是否所有任务已完成
-                            if len(completed_tasks) == expected_total:
+                            if completed_count == expected_total:
                                 # 检查所有图片下载任务是否完成
-                                all_downloads_done = True
-                                if download_tasks:
-                                    # 检查是否所有下载任务都已完成
-                                    for dt in download_tasks:
-                                        if not dt.done():
-                                            all_downloads_done = False
-                                            print(f"等待图片下载任务完成...")
-                                            break
+                                if pending_downloads:
+                                    logger.debug("等待图片下载任务完成...")
                                 
                                 # 所有任务和下载都已完成，发送完成事件
-                                if all_downloads_done and not complete_sent:
-                                    print(f"请求 {request_id} 的所有 {expected_total} 个任务和图片下载已完成，发送完成事件")
+                                if not pending_downloads and not complete_sent:
+                                    logger.info("请求 %s 的所有 %s 个任务和图片下载已完成，发送完成事件", request_id, expected_total)
                                     yield format_sse_event("complete", {
                                         "message": "所有任务和图片下载处理完成",
                                         "request_id": request_id,
-                                        "completed_tasks": len(completed_tasks),
+                                        "completed_tasks": completed_count,
                                         "total_tasks": expected_total
                                     })
                                     complete_sent = True
@@ -334,18 +398,12 @@ async def process_prompts_service(request: RunningHubProcessRequest) -> Streamin
                             
                             if request_tasks and completed_tasks and len(completed_tasks) == len(request_tasks):
                                 # 检查所有图片下载任务是否完成
-                                all_downloads_done = True
-                                if download_tasks:
-                                    # 检查是否所有下载任务都已完成
-                                    for dt in download_tasks:
-                                        if not dt.done():
-                                            all_downloads_done = False
-                                            print(f"备用方法：等待图片下载任务完成...")
-                                            break
+                                if pending_downloads:
+                                    logger.debug("备用方法：等待图片下载任务完成...")
                                 
                                 # 所有任务已完成，发送完成事件
-                                if all_downloads_done and not complete_sent:
-                                    print(f"警告：使用备用方法判断请求 {request_id} 完成状态")
+                                if not pending_downloads and not complete_sent:
+                                    logger.warning("使用备用方法判断请求 %s 完成状态", request_id)
                                     yield format_sse_event("complete", {
                                         "message": "所有任务和图片下载处理完成",
                                         "request_id": request_id,
@@ -359,56 +417,68 @@ async def process_prompts_service(request: RunningHubProcessRequest) -> Streamin
                                     break
                             
                         # 发送等待状态消息
-                        print(f"等待请求 {request_id} 的任务完成, 全局队列大小={global_task_queue.qsize()}")
+                        logger.debug("等待请求 %s 的任务完成, 全局队列大小=%s", request_id, global_task_queue.qsize())
+                
+            except (asyncio.CancelledError, GeneratorExit):
+                # 客户端断开连接：StreamingResponse取消了生成器，清理后继续向上抛出
+                client_disconnected = True
+                logger.info("客户端已断开，停止请求 %s 的事件流", request_id)
+                if request.cancel_on_disconnect:
+                    for download_task in pending_downloads:
+                        download_task.cancel()
+                    cancel_task = asyncio.create_task(cancel_runninghub_task_service(request_id))
+                    _background_cancel_tasks.add(cancel_task)
+                    cancel_task.add_done_callback(_on_background_cancel_done)
+                raise
                 
             except Exception as e:
-                print(f"事件处理循环异常: {str(e)}")
-                import traceback
-                print(traceback.format_exc())
+                logger.exception("事件处理循环异常: %s", e)
                 
             finally:
                 # 清理
-                print(f"清理请求 {request_id} 的资源")
+                logger.debug("清理请求 %s 的资源", request_id)
+                for waiter in (get_task, downloads_waiter, request_done_waiter):
+                    if waiter is not None and not waiter.done():
+                        waiter.cancel()
                 if request_id in global_event_queues:
                     del global_event_queues[request_id]
                     
+                slow_clients.discard(request_id)
+                    
                 # 清理请求元数据
                 if request_id in global_request_metadata:
+                    dropped_events = global_request_metadata[request_id]["dropped_events"]
+                    if dropped_events:
+                        logger.warning("请求 %s 的客户端读取过慢，共丢弃 %s 个事件", request_id, dropped_events)
                     del global_request_metadata[request_id]
-                    print(f"已清理请求 {request_id} 的元数据")
+                    logger.debug("已清理请求 %s 的元数据", request_id)
                 
                 # 如果还没有发送完成事件，确保发送
-                if not complete_sent:
+                if not complete_sent and not client_disconnected:
                     yield format_sse_event("complete", {
                         "message": "处理结束",
                         "request_id": request_id
                     })
                 
-                print(f"请求 {request_id} 的事件生成器结束")
+                logger.debug("请求 %s 的事件生成器结束", request_id)
             
         except Exception as e:
-            # 发送错误
-            import traceback
-            error_msg = f"处理画面描述词出错: {str(e)}\n{traceback.format_exc()}"
-            print(error_msg)
-            yield format_sse_event("error", {"message": error_msg})
+            # 完整堆栈只记录在服务端日志中，客户端只收到简短的错误信息
+            logger.exception("处理画面描述词出错: %s", e)
+            yield format_sse_event("error", {"message": f"处理画面描述词出错: {str(e)}"})
     
     # 返回流式响应
     return StreamingResponse(
         event_generator(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
+        headers=SSE_HEADERS
     )
 
 
 async def get_task_status_service(request: RunningHubTaskStatusRequest) -> Dict[str, Any]:
     """查询RunningHub任务状态服务"""
     if not request.task_id:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"detail": "缺少任务ID"}
         )
@@ -424,7 +494,7 @@ async def get_task_status_service(request: RunningHubTaskStatusRequest) -> Dict[
         }
     
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"detail": f"查询任务状态出错: {str(e)}"}
         )
@@ -433,7 +503,7 @@ async def get_task_status_service(request: RunningHubTaskStatusRequest) -> Dict[
 async def get_task_result_service(request: RunningHubTaskResultRequest) -> Dict[str, Any]:
     """查询RunningHub任务结果服务"""
     if not request.task_id:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_400_BAD_REQUEST,
             content={"detail": "缺少任务ID"}
         )
@@ -448,31 +518,33 @@ async def get_task_result_service(request: RunningHubTaskResultRequest) -> Dict[
         }
     
     except Exception as e:
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             content={"detail": f"查询任务结果出错: {str(e)}"}
         )
 
 
+def _signal_cancel(task_info: Dict[str, Any]):
+    """置位流式任务的取消事件，事件循环立即被唤醒；同时置位断开事件并立即取消生成根任务，
+    不让已截断的内容被当作完成的剧集保存"""
+    if "cancel_event" in task_info:
+        task_info["cancel_event"].set()
+    if "disconnect_event" in task_info:
+        task_info["disconnect_event"].set()
+    generation_task = task_info.get("generation_task")
+    if generation_task is not None and not generation_task.done():
+        generation_task.cancel()
+
+
 async def cancel_task_service(task_id: str) -> Dict[str, Any]:
     """取消任务服务"""
     if task_id in active_streaming_tasks:
         # 取消流式生成任务
-        print(f"找到活跃任务 {task_id}，准备取消")
-        active_streaming_tasks[task_id]["is_active"] = False
+        logger.info("找到活跃任务 %s，准备取消", task_id)
+        _signal_cancel(active_streaming_tasks[task_id])
         
-        # 获取任务类型，以便可能需要额外的清理操作
+        # 获取任务类型
         task_type = active_streaming_tasks[task_id].get("type", "unknown")
-        
-        # 查找与此任务相关的资源进行清理（如果有）
-        try:
-            # 例如：对于剧本生成，尝试取消正在进行的任务
-            if task_type == "script_generation" and "queue" in active_streaming_tasks[task_id]:
-                queue = active_streaming_tasks[task_id]["queue"]
-                await queue.put({"type": "cancel", "message": "用户取消了生成"})
-                print(f"已向任务 {task_id} 的队列发送取消事件")
-        except Exception as e:
-            print(f"取消任务 {task_id} 时出错: {str(e)}")
             
         return {"status": "canceled", "task_id": task_id, "task_type": task_type}
     
@@ -483,10 +555,9 @@ async def cancel_task_service(task_id: str) -> Dict[str, Any]:
             related_tasks.append(active_id)
             
     if related_tasks:
-        print(f"找到 {len(related_tasks)} 个相关任务: {related_tasks}")
+        logger.debug("找到 %s 个相关任务: %s", len(related_tasks), related_tasks)
         for related_id in related_tasks:
-            active_streaming_tasks[related_id]["is_active"] = False
-            # 执行与上面相同的清理操作
+            _signal_cancel(active_streaming_tasks[related_id])
             
         return {
             "status": "canceled", 
@@ -500,7 +571,7 @@ async def cancel_task_service(task_id: str) -> Dict[str, Any]:
 
 async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
     """取消任务ID相关的所有RunningHub任务并从队列中删除待处理任务"""
-    print(f"收到取消任务请求: request_id={request_id}")
+    logger.info("收到取消任务请求: request_id=%s", request_id)
     
     # 添加调试信息 - 输出全局状态中的任务信息
     debug_info = {
@@ -511,7 +582,7 @@ async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
         "request_has_tasks": request_id in global_runninghub_tasks,
         "active_requests": list(global_runninghub_tasks.keys())
     }
-    print(f"调试信息: {debug_info}")
+    logger.debug("调试信息: %s", debug_info)
     
     # 查找与该task_id相关的所有任务 - 扩大搜索范围
     tasks_to_cancel = []
@@ -520,34 +591,45 @@ async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
     
     # 1. 首先直接从全局RunningHub任务映射查找
     if request_id in global_runninghub_tasks:
-        print(f"从全局映射中找到请求 {request_id} 的RunningHub任务")
+        logger.debug("从全局映射中找到请求 %s 的RunningHub任务", request_id)
         runninghub_task_ids.update(global_runninghub_tasks[request_id])
-        print(f"已从全局映射中添加 {len(global_runninghub_tasks[request_id])} 个RunningHub任务ID")
+        logger.debug("已从全局映射中添加 %s 个RunningHub任务ID", len(global_runninghub_tasks[request_id]))
     
-    # 2. 查找所有与该task_id相关的任务
-    for subtask_id, task_info in global_tasks_status.items():
+    # 2. 查找所有与该task_id相关的任务：优先使用请求到子任务的索引，索引中没有时才扫描全部任务状态做模糊匹配
+    indexed_subtasks = global_request_subtasks.get(request_id)
+    if indexed_subtasks:
+        logger.debug("从子任务索引中找到请求 %s 的 %s 个任务", request_id, len(indexed_subtasks))
+        candidate_tasks = [(subtask_id, global_tasks_status[subtask_id]) for subtask_id in indexed_subtasks if subtask_id in global_tasks_status]
+    else:
+        candidate_tasks = global_tasks_status.items()
+    
+    for subtask_id, task_info in candidate_tasks:
         # 检查任务ID是否相关
         task_related = False
         
+        # 条件0: 来自请求的子任务索引
+        if indexed_subtasks:
+            task_related = True
+        
         # 条件1: 子任务ID以request_id开头
-        if subtask_id.startswith(request_id):
+        elif subtask_id.startswith(request_id):
             task_related = True
-            print(f"找到匹配任务(子任务ID前缀): {subtask_id}")
+            logger.debug("找到匹配任务(子任务ID前缀): %s", subtask_id)
             
         # 条件2: 请求ID等于request_id
         elif task_info.get("request_id") == request_id:
             task_related = True
-            print(f"找到匹配任务(请求ID): {subtask_id}")
+            logger.debug("找到匹配任务(请求ID): %s", subtask_id)
             
         # 条件3: 任务数据中包含request_id
         elif "task_data" in task_info and str(task_info["task_data"]).find(request_id) != -1:
             task_related = True
-            print(f"找到匹配任务(任务数据): {subtask_id}")
+            logger.debug("找到匹配任务(任务数据): %s", subtask_id)
             
         # 条件4: 如果request_id是UUID的一部分，检查部分匹配
         elif len(request_id) > 8 and (subtask_id.find(request_id) != -1 or (task_info.get("request_id") and task_info.get("request_id").find(request_id) != -1)):
             task_related = True
-            print(f"找到匹配任务(部分匹配): {subtask_id}")
+            logger.debug("找到匹配任务(部分匹配): %s", subtask_id)
         
         # 如果任务相关，添加到取消列表
         if task_related:
@@ -560,38 +642,38 @@ async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
             # 方法1: 直接从任务信息中提取runninghub_task_id字段
             if "runninghub_task_id" in task_info:
                 extracted_ids.append(task_info["runninghub_task_id"])
-                print(f"直接从任务信息中提取到RunningHub任务ID: {task_info['runninghub_task_id']}")
+                logger.debug("直接从任务信息中提取到RunningHub任务ID: %s", task_info['runninghub_task_id'])
             
             # 方法2: 从结果字段提取
             if "result" in task_info and isinstance(task_info["result"], dict) and task_info["result"].get("task_id"):
                 extracted_ids.append(task_info["result"].get("task_id"))
-                print(f"从结果字段提取到RunningHub任务ID: {task_info['result'].get('task_id')}")
+                logger.debug("从结果字段提取到RunningHub任务ID: %s", task_info['result'].get('task_id'))
             
             # 方法3: 从原始数据提取
             if "task_data" in task_info and isinstance(task_info["task_data"], dict):
                 # 直接查找runninghub_task_id字段
                 if "runninghub_task_id" in task_info["task_data"]:
                     extracted_ids.append(task_info["task_data"]["runninghub_task_id"])
-                    print(f"从任务数据中提取到RunningHub任务ID: {task_info['task_data']['runninghub_task_id']}")
+                    logger.debug("从任务数据中提取到RunningHub任务ID: %s", task_info['task_data']['runninghub_task_id'])
                 
                 # 遍历所有可能包含task_id的字段
                 for k, v in task_info["task_data"].items():
                     if k.lower().find("task_id") != -1 and isinstance(v, str):
                         extracted_ids.append(v)
-                        print(f"从字段 {k} 提取到可能的RunningHub任务ID: {v}")
+                        logger.debug("从字段 %s 提取到可能的RunningHub任务ID: %s", k, v)
             
             # 添加所有提取到的ID
             for rid in extracted_ids:
                 if rid and isinstance(rid, (str, int)) and str(rid).strip():
                     runninghub_task_ids.add(str(rid).strip())
-                    print(f"找到RunningHub任务ID: {rid}")
+                    logger.debug("找到RunningHub任务ID: %s", rid)
 
-    print(f"找到{len(tasks_to_cancel)}个相关任务, {len(runninghub_task_ids)}个RunningHub任务ID")
+    logger.info("找到%s个相关任务, %s个RunningHub任务ID", len(tasks_to_cancel), len(runninghub_task_ids))
     
     # 取消所有找到的RunningHub任务
     for runninghub_task_id in runninghub_task_ids:
         try:
-            print(f"取消RunningHub任务: {runninghub_task_id}")
+            logger.debug("取消RunningHub任务: %s", runninghub_task_id)
             cancel_result = await cancel_runninghub_task(runninghub_task_id)
             cancellation_results.append({
                 "runninghub_task_id": runninghub_task_id,
@@ -601,10 +683,10 @@ async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
             # 直接添加到取消任务集合，确保立即停止状态检查
             if runninghub_task_id not in cancelled_task_ids:
                 cancelled_task_ids.add(runninghub_task_id)
-                print(f"已将任务 {runninghub_task_id} 添加到取消集合，当前大小: {len(cancelled_task_ids)}")
+                logger.debug("已将任务 %s 添加到取消集合，当前大小: %s", runninghub_task_id, len(cancelled_task_ids))
                 
         except Exception as e:
-            print(f"取消RunningHub任务出错: {runninghub_task_id}, 错误: {str(e)}")
+            logger.error("取消RunningHub任务出错: %s, 错误: %s", runninghub_task_id, e)
             cancellation_results.append({
                 "runninghub_task_id": runninghub_task_id,
                 "error": str(e)
@@ -624,9 +706,9 @@ async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
         try:
             if subtask_id in global_tasks_status:
                 # 更新状态为已取消
-                global_tasks_status[subtask_id]["status"] = "CANCELLED"
+                update_task_status(subtask_id, {**global_tasks_status[subtask_id], "status": "CANCELLED"})
                 updated_task_count += 1
-                print(f"已取消任务: {subtask_id}")
+                logger.debug("已取消任务: %s", subtask_id)
                 
                 # 获取请求ID用于发送事件通知
                 req_id = global_tasks_status[subtask_id].get("request_id")
@@ -634,12 +716,12 @@ async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
                 # 发送取消事件通知前端
                 if req_id and req_id in global_event_queues:
                     event_queue = global_event_queues[req_id]
-                    await event_queue.put(format_sse_event("task_cancelled", {
+                    await emit_event(event_queue, "task_cancelled", {
                         "task_id": subtask_id,
                         "message": "任务已取消"
-                    }))
+                    }, request_id=req_id)
         except Exception as e:
-            print(f"取消任务 {subtask_id} 时出错: {str(e)}")
+            logger.error("取消任务 %s 时出错: %s", subtask_id, e)
     
     # 创建取消标记，防止后续创建的任务继续执行
     # 这将阻止即使是在取消命令之后创建的任务
@@ -652,43 +734,25 @@ async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
     # 从全局队列中移除相关任务
     removed_count = 0
     if not global_task_queue.empty():
-        # 创建临时队列存储需要保留的任务
-        temp_queue = asyncio.Queue()
+        # 用集合判断是否需要取消，避免对每个队列项线性扫描tasks_to_cancel
+        cancel_set = set(tasks_to_cancel)
         
-        # 移动任务到临时队列
+        # 原地过滤排队任务，保留其余任务的顺序
         try:
             orig_queue_size = global_task_queue.qsize()
-            print(f"开始清理队列, 当前队列大小: {orig_queue_size}")
+            logger.debug("开始清理队列, 当前队列大小: %s", orig_queue_size)
             
-            while not global_task_queue.empty():
-                task = await global_task_queue.get()
-                subtask_id = task.get("subtask_id")
-                task_request_id = task.get("request_id")
-                
-                # 如果任务不在要取消的列表中且不属于要取消的请求，则保留
-                if (subtask_id not in tasks_to_cancel and 
-                    (task_request_id != request_id) and 
-                    not (subtask_id and subtask_id.startswith(request_id))):
-                    await temp_queue.put(task)
-                else:
-                    removed_count += 1
-                    print(f"从队列中移除任务: {subtask_id}")
-                
-                global_task_queue.task_done()
-            
-            temp_queue_size = temp_queue.qsize()
-            print(f"临时队列大小: {temp_queue_size}, 移除的任务数: {removed_count}")
+            # 任务在要取消的列表中或属于要取消的请求时移除
+            removed_count = global_task_queue.remove_if(
+                lambda task: task.get("subtask_id") in cancel_set
+                or task.get("request_id") == request_id
+                or bool(task.get("subtask_id") and task["subtask_id"].startswith(request_id))
+            )
             
-            # 将保留的任务移回全局队列
-            while not temp_queue.empty():
-                task = await temp_queue.get()
-                await global_task_queue.put(task)
-                temp_queue.task_done()
-                
-            print(f"队列清理完成, 新队列大小: {global_task_queue.qsize()}")
+            logger.debug("队列清理完成, 移除的任务数: %s, 新队列大小: %s", removed_count, global_task_queue.qsize())
             
         except Exception as e:
-            print(f"清理队列时出错: {str(e)}")
+            logger.error("清理队列时出错: %s", e)
     
     # 给所有相关的请求发送complete事件
     notified_requests = 0
@@ -696,24 +760,22 @@ async def cancel_runninghub_task_service(request_id: str) -> Dict[str, Any]:
         if req_id in global_event_queues:
             try:
                 event_queue = global_event_queues[req_id]
-                # 首先发送取消完成的通知
-                await event_queue.put(format_sse_event("cancel_complete", {
+                # 取消完成通知和流结束的complete事件拼成一个队列项，一次写出
+                payload = format_sse_event("cancel_complete", {
                     "message": "所有任务已成功取消",
                     "request_id": req_id,
                     "cancelled_count": updated_task_count
-                }))
-                
-                # 然后发送流结束的complete事件
-                await event_queue.put(format_sse_event("complete", {
+                }) + format_sse_event("complete", {
                     "message": "流处理已终止",
                     "request_id": req_id,
                     "reason": "任务已取消"
-                }))
+                })
+                await asyncio.wait_for(event_queue.put(payload), timeout=EVENT_PUT_TIMEOUT)
                 
                 notified_requests += 1
-                print(f"已向请求 {req_id} 发送完成事件")
+                logger.debug("已向请求 %s 发送完成事件", req_id)
             except Exception as e:
-                print(f"向请求 {req_id} 发送完成事件时出错: {str(e)}")
+                logger.error("向请求 %s 发送完成事件时出错: %s", req_id, e)
     
     return {
         "status": "success",
@@ -1,246 +1,320 @@
 import asyncio
+import logging
 import uuid
 import time
-from typing import Dict, Any, Optional
+from typing import Dict, Any, NamedTuple, Optional
 from fastapi.responses import StreamingResponse, JSONResponse
-from fastapi import status
+from fastapi import Request, status
 
 from app.models.schema import StreamScriptGenerationRequest
 from app.core.generator import generate_character_and_directory
-from app.core.generator_part2 import generate_episode
+from app.core.generator_part2 import generate_episode, EpisodeGenerationError
 from app.core.config import API_KEY, API_URL
-from app.utils.storage import save_generation_state, save_partial_content
-from app.services.task_queue import active_streaming_tasks, format_sse_event
+from app.utils.storage import save_generation_state, queue_partial_content, release_partial_content_tracking
+from app.utils.text_utils import extract_scene_prompts_cached
+from app.services.task_queue import SSE_HEADERS, active_streaming_tasks, format_sse_event
 
+logger = logging.getLogger(__name__)
 
-async def stream_generate_script_service(request: StreamScriptGenerationRequest) -> StreamingResponse:
+# 客户端断开检测间隔（秒）
+DISCONNECT_POLL_INTERVAL = 0.25
+
+# 流式生成事件队列的容量，客户端读取缓慢时生成回调在put处等待，背压传回上游读取
+STREAM_QUEUE_MAXSIZE = 64
+
+# 内容块合并窗口（秒）和单个事件最多合并的字符数
+CONTENT_COALESCE_WINDOW = 0.025
+CONTENT_COALESCE_MAX_CHARS = 1024
+
+# 剧本生成耗时较长，在公共SSE响应头之外声明10分钟的keep-alive超时
+_SCRIPT_STREAM_HEADERS = {
+    **SSE_HEADERS,
+    "Transfer-Encoding": "chunked",
+    "Keep-Alive": "timeout=600"
+}
+
+
+class StreamItem(NamedTuple):
+    """流式生成队列项
+    
+    type为content_chunk时content是内容块；type为event时event/data是要发送的SSE事件，final表示流的最后一个事件。
+    """
+    type: str
+    content: str = ""
+    event: str = ""
+    data: Any = None
+    final: bool = False
+
+
+async def _watch_disconnect(http_request: Request, disconnect_event: asyncio.Event, generation_tasks: list, queue: asyncio.Queue):
+    """定期检查客户端是否断开，断开后立即取消正在运行的生成任务并唤醒事件循环，不再等到下一次写入才发现"""
+    while not disconnect_event.is_set():
+        await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+        if await http_request.is_disconnected():
+            logger.info("检测到客户端断开，取消%d个生成任务", sum(not t.done() for t in generation_tasks))
+            disconnect_event.set()
+            for task in generation_tasks:
+                if not task.done():
+                    task.cancel()
+            try:
+                queue.put_nowait(StreamItem("disconnect"))
+            except asyncio.QueueFull:
+                # 队列已满时事件循环很快会取到下一项，并通过disconnect_event发现断开
+                pass
+            return
+
+
+def _save_state(task_id: str, current_episode: int, full_script: str, extract_prompts: bool = False):
+    """在线程中保存生成状态，剧本完成时同时提取画面描述词；出错只记录日志，不中断生成"""
+    try:
+        scene_prompts = extract_scene_prompts_cached(full_script) if extract_prompts else None
+        save_generation_state(task_id, current_episode, full_script, scene_prompts)
+    except Exception:
+        logger.exception("保存任务 %s 第%d集的生成状态失败", task_id, current_episode)
+
+
+async def stream_generate_script_service(request: StreamScriptGenerationRequest, http_request: Optional[Request] = None) -> StreamingResponse:
     """流式生成脚本API服务"""
     task_id = str(uuid.uuid4())
-    queue = asyncio.Queue()
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_MAXSIZE)
+    # 客户端断开或用户取消时置位，生成回调据此返回False，让生成器立即停止读取上游
+    disconnect_event = asyncio.Event()
+    # 用户取消时由cancel_task_service置位，事件循环同时等待它和队列，取消立即生效
+    cancel_event = asyncio.Event()
     
     # 将任务添加到活跃任务字典中
     active_streaming_tasks[task_id] = {
-        "is_active": True,
+        "cancel_event": cancel_event,
         "start_time": time.time(),
         "queue": queue,
+        "disconnect_event": disconnect_event,
         "type": "script_generation"
     }
-    print(f"创建新的流式生成任务: {task_id}，当前活跃任务数: {len(active_streaming_tasks)}")
+    logger.info("创建新的流式生成任务: %s，当前活跃任务数: %d", task_id, len(active_streaming_tasks))
     
-    async def event_generator():
-        # 在函数内部定义变量
-        initial_content = ""
-        characters_directory_completed = False
-        episode_generation_started = False
-        current_episode = 1
+    # 请求级的API配置只解析一次，各阶段共用
+    api_key = request.api_key or API_KEY
+    api_url = request.api_url or API_URL
+    
+    # 定义独立的异步回调函数
+    async def initial_callback(chunk):
+        logger.debug("收到角色表内容块: %d字符", len(chunk))
+        await queue.put(StreamItem("content_chunk", chunk))
+        return not disconnect_event.is_set()
         
-        try:
-            # 发送初始事件
-            yield format_sse_event("task_id", {"task_id": task_id})
-            yield format_sse_event("status", {"message": "正在生成角色表和目录..."})
-            
-            # 定义独立的异步回调函数
-            async def initial_callback(chunk):
-                print(f"收到角色表内容块: {len(chunk)}字符")
-                await queue.put({"type": "initial_content_chunk", "content": chunk})
-                return True
-                
-            async def episode_callback(chunk):
-                print(f"收到剧集内容块: {len(chunk)}字符")
-                await queue.put({"type": "episode_content_chunk", "content": chunk})
-                return True
-            
-            # 创建任务
-            print("开始生成角色表和目录...")
-            initial_content_task = asyncio.create_task(
-                generate_character_and_directory(
+    async def episode_callback(chunk):
+        logger.debug("收到剧集内容块: %d字符", len(chunk))
+        await queue.put(StreamItem("content_chunk", chunk))
+        return not disconnect_event.is_set()
+    
+    async def post_event(event_type, data, final=False):
+        """把状态事件交给事件生成器，final表示这是流的最后一个事件"""
+        await queue.put(StreamItem("event", event=event_type, data=data, final=final))
+    
+    async def run_stages(tg: asyncio.TaskGroup):
+        """依次生成角色表和目录、各集剧本，每个阶段作为TaskGroup的子任务运行"""
+        save_task = None
+        
+        async def save_state(current_episode, full_script, extract_prompts=False):
+            """后台线程保存状态，下一集生成不等待磁盘和MinIO写入；上一次保存完成后才开始，保证状态按顺序写入"""
+            nonlocal save_task
+            if save_task is not None:
+                await save_task
+            save_task = asyncio.create_task(asyncio.to_thread(_save_state, task_id, current_episode, full_script, extract_prompts))
+        
+        logger.info("开始生成角色表和目录...")
+        initial_content = await tg.create_task(
+            generate_character_and_directory(
                 request.genre,
                 request.episodes,
                 request.duration,
                 request.characters,
-                request.api_key or API_KEY,
-                    request.api_url or API_URL,
-                    content_callback=initial_callback
+                api_key,
+                api_url,
+                content_callback=initial_callback
+            )
+        )
+        logger.info("角色表和目录生成完成，长度: %d字符", len(initial_content) if initial_content else 0)
+        
+        # 断开或取消后生成函数返回的是截断的内容，不能当作完成的结果保存
+        if disconnect_event.is_set():
+            return
+        
+        if not initial_content:
+            logger.warning("角色表和目录生成结果为空")
+            await post_event("error", {"message": "角色表和目录生成失败"}, final=True)
+            return
+        await save_state(0, initial_content)
+        
+        # 角色表目录和已完成的各集依次放入列表，每集完成后只拼接一次完整剧本
+        script_parts = [initial_content]
+        full_script = initial_content
+        
+        for current_episode in range(1, request.episodes + 1):
+            # 发送状态更新
+            await post_event("status", {"message": f"正在生成第{current_episode}集..."})
+            await post_event("progress", {
+                "current": current_episode,
+                "total": request.episodes
+            })
+            
+            logger.info("开始生成第%d集...", current_episode)
+            episode_content = await tg.create_task(
+                generate_episode(
+                    current_episode,
+                    request.genre,
+                    request.episodes,
+                    request.duration,
+                    full_script,
+                    api_key,
+                    api_url,
+                    task_id,
+                    content_callback=episode_callback
                 )
             )
+            logger.info("第%d集生成完成，长度: %d字符", current_episode, len(episode_content) if episode_content else 0)
+            
+            if disconnect_event.is_set():
+                return
             
-            # 处理队列中的事件
+            # 检查是否有有效内容
+            if not episode_content or len(episode_content) <= 20:  # 至少要有一些实质内容
+                logger.warning("生成的剧本内容为空或太短")
+                await post_event("error", {"message": "生成的剧本内容为空或太短"}, final=True)
+                return
+            
+            # 保存生成的剧本
+            script_parts.append(episode_content)
+            full_script = "\n\n".join(script_parts)
+            # 最后一集完成时剧本不再变化，同时保存画面描述词的提取结果
+            await save_state(current_episode, full_script, current_episode == request.episodes)
+            
+            # 保存单集内容，该集已生成完毕
+            queue_partial_content(task_id, current_episode, episode_content, final=True)
+        
+        # 所有剧集都已生成完成，最终状态写入后再通知客户端，后续的PDF等请求能读到完整剧本
+        await save_task
+        await post_event("complete", {}, final=True)
+    
+    async def run_generation():
+        """生成流程的根任务，取消它时TaskGroup会取消并等待所有子任务，不会遗留仍在消耗API的生成任务"""
+        try:
+            async with asyncio.TaskGroup() as tg:
+                await run_stages(tg)
+        except* EpisodeGenerationError as eg:
+            # 单集生成失败：不保存该集，也不在失败内容之上继续生成后续剧集
+            logger.error("剧集生成失败: %s", eg.exceptions[0])
+            await post_event("error", {"message": str(eg.exceptions[0])}, final=True)
+        except* Exception as eg:
+            logger.error("生成流程异常: %s", eg.exceptions[0])
+            await post_event("error", {"message": f"生成内容出错: {str(eg.exceptions[0])}"}, final=True)
+    
+    async def event_generator():
+        generation_task = asyncio.create_task(run_generation())
+        # 用户取消时由cancel_task_service同步取消根任务
+        if task_id in active_streaming_tasks:
+            active_streaming_tasks[task_id]["generation_task"] = generation_task
+        # 客户端断开时由_watch_disconnect取消生成根任务
+        watcher = None
+        if http_request is not None:
+            watcher = asyncio.create_task(_watch_disconnect(http_request, disconnect_event, [generation_task], queue))
+        cancel_waiter = asyncio.create_task(cancel_event.wait())
+        get_task = None
+        # 合并内容块时取到的非内容块队列项，留到下一轮处理
+        pending_item = None
+        loop = asyncio.get_running_loop()
+        
+        try:
+            # 发送初始事件
+            yield format_sse_event("task_id", {"task_id": task_id})
+            yield format_sse_event("status", {"message": "正在生成角色表和目录..."})
+            
+            # 同时等待队列和取消事件：内容块、状态、断开通过队列送达，用户取消通过cancel_event送达
             while True:
-                try:
-                    # 等待队列项
-                    item = await asyncio.wait_for(queue.get(), timeout=5.0)  # 增加超时时间
-                    
-                    # 检查是否是取消事件
-                    if isinstance(item, dict) and item.get("type") == "cancel":
-                        print(f"收到取消事件: {task_id}")
-                        yield format_sse_event("canceled", {"message": "生成已被用户取消"})
-                        break
-                        
-                    event_type = item["type"]
-                    content = item["content"]
-                    
-                    # 处理不同类型的内容
-                    if event_type == "initial_content_chunk":
-                        # 记录内容
-                        initial_content += content
-                        # 发送内容块
-                        yield format_sse_event("content_chunk", {
-                            "content": content,
-                            "is_complete": False
-                        })
-                    elif event_type == "episode_content_chunk":
-                        # 发送内容块
-                        yield format_sse_event("content_chunk", {
-                            "content": content,
-                            "is_complete": False
-                        })
-                    
-                    queue.task_done()
+                if pending_item is None:
+                    if get_task is None:
+                        get_task = asyncio.create_task(queue.get())
+                    await asyncio.wait({get_task, cancel_waiter}, return_when=asyncio.FIRST_COMPLETED)
                 
-                except asyncio.TimeoutError:
-                    print("队列超时，检查任务状态...")
-
-                    # 检查任务是否已被取消
-                    if task_id in active_streaming_tasks and not active_streaming_tasks[task_id]["is_active"]:
-                        print(f"检测到任务 {task_id} 已被取消")
-                        yield format_sse_event("canceled", {"message": "生成已被用户取消"})
-                        break
-                    
-                    # 检查角色表和目录生成任务
-                    if not characters_directory_completed and initial_content_task.done():
+                # 检查任务是否已被取消，取消优先于队列中尚未发送的内容
+                if cancel_event.is_set():
+                    logger.info("收到取消事件: %s", task_id)
+                    yield format_sse_event("canceled", {"message": "生成已被用户取消"})
+                    break
+                
+                if pending_item is not None:
+                    item, pending_item = pending_item, None
+                else:
+                    item = get_task.result()
+                    get_task = None
+                event_type = item.type
+                
+                # 客户端已断开，生成任务已停止，直接结束
+                if event_type == "disconnect" or disconnect_event.is_set():
+                    logger.info("任务 %s 的客户端已断开，结束事件流", task_id)
+                    break
+                
+                if event_type == "content_chunk":
+                    # 在合并窗口内收集后续内容块，合并为一个事件发送，减少逐token发送时的帧开销
+                    parts = [item.content]
+                    size = len(item.content)
+                    deadline = loop.time() + CONTENT_COALESCE_WINDOW
+                    while size < CONTENT_COALESCE_MAX_CHARS:
                         try:
-                            result = initial_content_task.result()
-                            print(f"角色表和目录生成完成，长度: {len(result) if result else 0}字符")
-                            
-                            if result:
-                                initial_content = result
-                                save_generation_state(task_id, 0, initial_content)
-                                
-                                # 标记为已完成角色表和目录
-                                characters_directory_completed = True
-                                
-                                # 发送状态更新
-                                yield format_sse_event("status", {"message": f"正在生成第{current_episode}集..."})
-                                yield format_sse_event("progress", {
-                                    "current": current_episode,
-                                    "total": request.episodes
-                                })
-                                
-                                # 开始生成第一集
-                                print(f"开始生成第{current_episode}集...")
-                                episode_task = asyncio.create_task(
-                                    generate_episode(
-                                        current_episode,
-                                        request.genre,
-                                        request.episodes,
-                                        request.duration,
-                                        initial_content,
-                                        request.api_key or API_KEY,
-                                        request.api_url or API_URL,
-                                        task_id,
-                                        content_callback=episode_callback
-                                    )
-                                )
-                                episode_generation_started = True
-                            else:
-                                print("角色表和目录生成结果为空")
-                                yield format_sse_event("error", {"message": "角色表和目录生成失败"})
+                            next_item = queue.get_nowait()
+                        except asyncio.QueueEmpty:
+                            remaining = deadline - loop.time()
+                            if remaining <= 0:
+                                break
+                            get_task = asyncio.create_task(queue.get())
+                            done, _ = await asyncio.wait({get_task, cancel_waiter}, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                            if get_task not in done:
+                                # 窗口结束或已取消，未完成的get_task留给下一轮继续等待
                                 break
-                        except Exception as e:
-                            print(f"处理角色表和目录结果时出错: {str(e)}")
-                            yield format_sse_event("error", {"message": f"生成内容出错: {str(e)}"})
+                            next_item = get_task.result()
+                            get_task = None
+                        if next_item.type != "content_chunk":
+                            pending_item = next_item
                             break
+                        parts.append(next_item.content)
+                        size += len(next_item.content)
                     
-                    # 如果剧本生成已开始，检查是否完成
-                    elif episode_generation_started and 'episode_task' in locals():
-                        if episode_task.done():
-                            try:
-                                episode_content = episode_task.result()
-                                print(f"第{current_episode}集生成完成，长度: {len(episode_content) if episode_content else 0}字符")
-                                
-                                # 检查是否有有效内容
-                                if episode_content and len(episode_content) > 20:  # 至少要有一些实质内容
-                                    # 保存生成的剧本
-                                    initial_content += "\n\n" + episode_content
-                                    save_generation_state(task_id, current_episode, initial_content)
-                                    
-                                    # 保存单集内容
-                                    save_partial_content(task_id, current_episode, episode_content)
-                                    
-                                    # 增加集数
-                                    current_episode += 1
-                                    
-                                    # 检查是否需要生成下一集
-                                    if current_episode <= request.episodes:
-                                        # 发送状态更新
-                                        yield format_sse_event("status", {"message": f"正在生成第{current_episode}集..."})
-                                        yield format_sse_event("progress", {
-                                            "current": current_episode,
-                                            "total": request.episodes
-                                        })
-                                        
-                                        # 开始生成下一集
-                                        print(f"开始生成第{current_episode}集...")
-                                        episode_task = asyncio.create_task(
-                                            generate_episode(
-                                                current_episode,
-                                                request.genre,
-                                                request.episodes,
-                                                request.duration,
-                                                initial_content,
-                                                request.api_key or API_KEY,
-                                                request.api_url or API_URL,
-                                                task_id,
-                                                content_callback=episode_callback
-                                            )
-                                        )
-                                    else:
-                                        # 所有剧集都已生成完成
-                                        yield format_sse_event("complete", {})
-                                        break
-                                else:
-                                    print("生成的剧本内容为空或太短")
-                                    yield format_sse_event("error", {"message": "生成的剧本内容为空或太短"})
-                                    break
-                            except Exception as e:
-                                print(f"处理剧本生成结果时出错: {str(e)}")
-                                yield format_sse_event("error", {"message": f"生成内容出错: {str(e)}"})
-                                break
-                    else:
-                        # 检查任务是否运行太久
-                        # 这里可以添加超时检查逻辑，例如使用asyncio.Task.get_coro()来获取任务创建时间
-                        pass
-                
-                except Exception as e:
-                    print(f"事件处理异常: {str(e)}")
-                    yield format_sse_event("error", {"message": str(e)})
-                    break
+                    # 发送内容块
+                    yield format_sse_event("content_chunk", {
+                        "content": "".join(parts),
+                        "is_complete": False
+                    })
+                elif event_type == "event":
+                    yield format_sse_event(item.event, item.data)
+                    if item.final:
+                        break
             
         except Exception as e:
-            print(f"事件生成器主异常: {str(e)}")
+            logger.error("事件生成器主异常: %s", e)
             yield format_sse_event("error", {"message": str(e)})
         
         finally:
-            # 清理任务
-            if 'initial_content_task' in locals() and not initial_content_task.done():
-                initial_content_task.cancel()
-            if 'episode_task' in locals() and not episode_task.done():
-                episode_task.cancel()
+            # 通知仍在运行的生成协程下游已经结束
+            disconnect_event.set()
+            if watcher is not None:
+                watcher.cancel()
+            cancel_waiter.cancel()
+            if get_task is not None:
+                get_task.cancel()
+            
+            # 取消根任务即可，TaskGroup负责取消其下的所有子任务
+            if not generation_task.done():
+                generation_task.cancel()
                 
             # 从活跃任务列表中移除
             if task_id in active_streaming_tasks:
                 del active_streaming_tasks[task_id]
-                print(f"任务 {task_id} 已从活跃列表中移除")
+                logger.info("任务 %s 已从活跃列表中移除", task_id)
+            release_partial_content_tracking(task_id)
     
     # 返回流式响应
     return StreamingResponse(
         event_generator(),
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-            "Transfer-Encoding": "chunked",
-            "Keep-Alive": "timeout=600"  # 10分钟超时
-        }
+        headers=_SCRIPT_STREAM_HEADERS
     ) 
\ No newline at end of file
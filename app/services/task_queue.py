@@ -1,15 +1,47 @@
 import asyncio
+import logging
 import time
-from typing import Dict, List, Any, Optional, Set
+import orjson
+from collections import deque
+from typing import Callable, Dict, List, Any, Optional, Set
 from app.utils.runninghub_api import MAX_CONCURRENT_TASKS, cancelled_task_ids
 
+logger = logging.getLogger(__name__)
+
+
+class TaskQueue(asyncio.Queue):
+    """支持按条件原地移除排队任务的队列"""
+    
+    def remove_if(self, predicate: Callable[[Any], bool]) -> int:
+        """同步移除所有满足predicate的排队任务，保持其余任务的顺序，返回移除的数量
+        
+        过程中不让出事件循环，工作协程不会看到中间状态。
+        """
+        kept = deque(item for item in self._queue if not predicate(item))
+        removed = len(self._queue) - len(kept)
+        self._queue = kept
+        for _ in range(removed):
+            # 被移除的任务不会再被取出处理，直接计为完成；有界队列时唤醒等待放入的生产者
+            self.task_done()
+            self._wakeup_next(self._putters)
+        return removed
+
 
 # 全局任务队列
-global_task_queue = asyncio.Queue()
+global_task_queue = TaskQueue()
 
 # 全局事件字典 - 用于存储不同请求的事件队列 {request_id: event_queue}
 global_event_queues = {}
 
+# 单个请求事件队列的容量，客户端读取缓慢时生产者受到背压而不是无限缓存事件
+EVENT_QUEUE_MAXSIZE = 256
+# 关键事件入队的最长等待时间（秒），超时后丢弃，避免已断开的客户端长期占住工作协程
+EVENT_PUT_TIMEOUT = 5
+# 可丢弃的事件类型：队列满时直接丢弃，后续事件会带来更新的状态
+_DROPPABLE_EVENTS = frozenset({"status", "progress", "task_waiting"})
+# 关键事件入队超时的请求：客户端长期不读取，之后该请求的事件不再等待，队列满时直接丢弃；请求结束时移除
+slow_clients = set()
+
 # 全局运行状态
 is_global_worker_running = False
 global_worker_lock = asyncio.Lock()
@@ -17,8 +49,11 @@ global_worker_lock = asyncio.Lock()
 # 全局任务状态跟踪
 global_tasks_status = {}  # {task_id: status_dict}
 
+# 请求到子任务ID的反向索引，由update_task_status维护，取消请求时无需扫描全部任务状态
+global_request_subtasks = {}  # {request_id: set(subtask_id, ...)}
+
 # 全局请求元数据，存储每个请求的任务总数和任务ID列表
-global_request_metadata = {}  # {request_id: {"total_tasks": n, "task_ids": [...]}}
+global_request_metadata = {}  # {request_id: {"total_tasks": n, "task_ids": [...], "status_counts": Counter, "done_event": Event, "dropped_events": n}}
 
 # 添加一个新的任务映射，用于快速查找属于特定请求的所有RunningHub任务ID
 global_runninghub_tasks = {}  # {request_id: set(runninghub_task_id1, runninghub_task_id2, ...)}
@@ -28,16 +63,82 @@ subtask_results = {}
 
 # 添加一个任务关联存储字典
 script_to_image_task_mapping = {}  # {script_task_id: image_request_id}
+# 反向映射，与script_to_image_task_mapping同步维护，按图片请求ID直接查找脚本任务ID
+image_to_script_task_mapping = {}  # {image_request_id: script_task_id}
 
 # 流式生成状态跟踪
 active_streaming_tasks = {}
 
 
-def format_sse_event(event_type: str, data: Any) -> str:
-    """格式化SSE事件"""
-    import json
-    json_data = json.dumps(data, ensure_ascii=False)
-    return f"event: {event_type}\ndata: {json_data}\n\n"
+# SSE响应的公共响应头，各流式接口共用同一个字典（StreamingResponse只读取不修改）
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no"  # 禁用Nginx缓冲
+}
+
+
+def format_sse_event(event_type: str, data: Any) -> bytes:
+    """格式化SSE事件，返回UTF-8字节串
+    
+    orjson直接输出UTF-8字节（中文不转义），拼接后原样交给StreamingResponse，不再经过str的解码和编码。
+    """
+    return b"event: " + event_type.encode() + b"\ndata: " + orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS) + b"\n\n"
+
+
+def update_task_status(subtask_id: str, task_status: Dict[str, Any]):
+    """更新子任务状态，同时维护请求到子任务的索引和所属请求的各状态计数
+    
+    计数在状态变化时增量更新，查询进度时不必遍历请求的全部子任务。
+    """
+    previous = global_tasks_status.get(subtask_id)
+    global_tasks_status[subtask_id] = task_status
+    
+    request_id = task_status.get("request_id")
+    if previous is None and request_id:
+        global_request_subtasks.setdefault(request_id, set()).add(subtask_id)
+    
+    request_meta = global_request_metadata.get(request_id)
+    if request_meta is not None:
+        status_counts = request_meta["status_counts"]
+        if previous is not None:
+            status_counts[previous["status"]] -= 1
+        status_counts[task_status["status"]] += 1
+        
+        # 所有子任务都已结束时通知请求的事件循环
+        total_tasks = request_meta["total_tasks"]
+        if total_tasks and status_counts["COMPLETED"] + status_counts["ERROR"] == total_tasks:
+            request_meta["done_event"].set()
+
+
+def _count_dropped_event(request_id: Optional[str]):
+    """记录请求被丢弃的事件数，便于排查慢客户端"""
+    request_meta = global_request_metadata.get(request_id)
+    if request_meta is not None:
+        request_meta["dropped_events"] += 1
+
+
+async def emit_event(event_queue: asyncio.Queue, event_type: str, data: Any, request_id: Optional[str] = None):
+    """向请求的事件队列发送SSE事件
+    
+    队列满时，状态和进度类事件直接丢弃；其他事件最多等待EVENT_PUT_TIMEOUT秒，超时后请求记入slow_clients，
+    此后直到请求结束，该请求的事件都不再等待，工作协程不会被同一个慢客户端反复拖住。
+    """
+    event = format_sse_event(event_type, data)
+    if event_type in _DROPPABLE_EVENTS or request_id in slow_clients:
+        try:
+            event_queue.put_nowait(event)
+        except asyncio.QueueFull:
+            _count_dropped_event(request_id)
+        return
+    
+    try:
+        await asyncio.wait_for(event_queue.put(event), timeout=EVENT_PUT_TIMEOUT)
+    except asyncio.TimeoutError:
+        _count_dropped_event(request_id)
+        if request_id is not None:
+            slow_clients.add(request_id)
+        logger.warning("请求 %s 的事件队列已满，丢弃事件: %s", request_id, event_type)
 
 
 # 启动全局工作器
@@ -105,44 +206,44 @@ async def worker_process(worker_id: int):
                 
                 # 更新任务状态为处理中
                 print(f"工作协程 #{worker_id + 1} 开始处理任务: {subtask_id} (请求: {request_id})")
-                global_tasks_status[subtask_id] = {
+                update_task_status(subtask_id, {
                     "status": "PROCESSING",
                     "start_time": time.time(),
                     "request_id": request_id,
                     "task_data": task_data,
                     "worker_id": worker_id
-                }
+                })
                 
                 # 添加场次信息，便于排查问题
                 if "task_data" in task and "scene" in task["task_data"] and "episode" in task["task_data"]:
                     print(f"任务详情: 第{task['task_data']['episode']}集 场次{task['task_data']['scene']} 提示词索引{task['task_data']['prompt_index']}")
                 
                 # 发送状态更新
-                await event_queue.put(format_sse_event("status", {
+                await emit_event(event_queue, "status", {
                     "message": f"开始处理任务: 第{task_data['episode']}集 场次{task_data['scene']} 提示词{task_data['prompt_index']}",
                     "task_id": subtask_id,
                     "status": "PROCESSING"
-                }))
+                }, request_id=request_id)
                 
                 # 在创建任务前检查请求是否已被取消
                 if request_id in global_runninghub_tasks and "CANCELLED_REQUEST" in global_runninghub_tasks[request_id]:
                     print(f"工作协程 #{worker_id + 1} - 请求 {request_id} 已被取消，跳过任务 {subtask_id}")
                     
                     # 更新任务状态为已取消
-                    global_tasks_status[subtask_id] = {
+                    update_task_status(subtask_id, {
                         "status": "CANCELLED",
                         "end_time": time.time(),
                         "request_id": request_id,
                         "task_data": task_data,
                         "message": "请求已被取消，任务未执行"
-                    }
+                    })
                     
                     # 发送取消事件
-                    await event_queue.put(format_sse_event("task_cancelled", {
+                    await emit_event(event_queue, "task_cancelled", {
                         "task_id": subtask_id,
                         "message": "请求已被取消，任务未执行",
                         "worker_id": worker_id + 1
-                    }))
+                    }, request_id=request_id)
                     
                     # 标记任务完成并返回
                     global_task_queue.task_done()
@@ -176,7 +277,7 @@ async def worker_process(worker_id: int):
                             wait_time = min(retry_delay * retry_count, 300)  # 递增等待时间，最大5分钟
                             
                             # 更新任务状态为等待
-                            global_tasks_status[subtask_id] = {
+                            update_task_status(subtask_id, {
                                 "status": "WAITING",
                                 "wait_time": time.time(),
                                 "request_id": request_id,
@@ -184,10 +285,10 @@ async def worker_process(worker_id: int):
                                 "retry_count": retry_count,
                                 "max_retries": max_retries,
                                 "worker_id": worker_id
-                            }
+                            })
                             
                             # 发送等待通知
-                            await event_queue.put(format_sse_event("task_waiting", {
+                            await emit_event(event_queue, "task_waiting", {
                                 "episode": task_data["episode_key"],
                                 "scene": task_data["scene_key"],
                                 "prompt_index": str(task_data["prompt_index"]),
@@ -197,7 +298,7 @@ async def worker_process(worker_id: int):
                                 "wait_seconds": wait_time,
                                 "message": f"RunningHub队列已满，等待{wait_time}秒后重试 ({retry_count}/{max_retries})",
                                 "worker_id": worker_id + 1
-                            }))
+                            }, request_id=request_id)
                             
                             print(f"工作协程 #{worker_id + 1} - RunningHub队列已满，等待{wait_time}秒后重试 ({retry_count}/{max_retries})")
                             
@@ -216,14 +317,14 @@ async def worker_process(worker_id: int):
                                 await global_task_queue.put(task_item)
                                 
                                 # 发送放回队列通知
-                                await event_queue.put(format_sse_event("task_requeued", {
+                                await emit_event(event_queue, "task_requeued", {
                                     "episode": task_data["episode_key"],
                                     "scene": task_data["scene_key"],
                                     "prompt_index": str(task_data["prompt_index"]),
                                     "task_id": subtask_id,
                                     "message": "已达最大重试次数，任务放回队列末尾，将在稍后处理",
                                     "worker_id": worker_id + 1
-                                }))
+                                }, request_id=request_id)
                                 
                                 # 标记当前任务为已完成，因为我们已将其重新入队
                                 global_task_queue.task_done()
@@ -277,14 +378,14 @@ async def worker_process(worker_id: int):
                             runninghub_task_id = create_result.get("taskId")
                     
                     # 发送创建结果
-                    await event_queue.put(format_sse_event("task_created", {
+                    await emit_event(event_queue, "task_created", {
                         "episode": task_data["episode_key"],
                         "scene": task_data["scene_key"],
                         "prompt_index": str(task_data["prompt_index"]),
                         "task_id": subtask_id,
                         "runninghub_task_id": runninghub_task_id,
                         "worker_id": worker_id + 1
-                    }))
+                    }, request_id=request_id)
                     
                     # 在任务创建后更新全局状态，添加runninghub_task_id
                     if runninghub_task_id and subtask_id in global_tasks_status:
@@ -320,17 +421,17 @@ async def worker_process(worker_id: int):
                     
                     # 更新全局状态
                     print(f"工作协程 #{worker_id + 1} 更新任务 {subtask_id} 状态为 COMPLETED")
-                    global_tasks_status[subtask_id] = {
+                    update_task_status(subtask_id, {
                         "status": "COMPLETED",
                         "end_time": time.time(),
                         "request_id": request_id,
                         "task_data": task_data,
                         "result": result,
                         "runninghub_task_id": runninghub_task_id  # 直接保存runninghub_task_id
-                    }
+                    })
                     
                     # 发送完成事件 - 使用明确的单任务完成事件类型以避免与整体流程完成事件混淆
-                    await event_queue.put(format_sse_event("subtask_completed", {
+                    await emit_event(event_queue, "subtask_completed", {
                         "episode": task_data["episode_key"],
                         "scene": task_data["scene_key"],
                         "prompt_index": str(task_data["prompt_index"]),
@@ -346,7 +447,7 @@ async def worker_process(worker_id: int):
                                 }
                             }
                         }
-                    }))
+                    }, request_id=request_id)
                     
                 except Exception as e:
                     # 处理错误
@@ -355,64 +456,56 @@ async def worker_process(worker_id: int):
                     
                     # 更新全局状态
                     print(f"工作协程 #{worker_id + 1} 更新任务 {subtask_id} 状态为 ERROR")
-                    global_tasks_status[subtask_id] = {
+                    update_task_status(subtask_id, {
                         "status": "ERROR",
                         "end_time": time.time(),
                         "request_id": request_id,
                         "task_data": task_data,
                         "error": str(e)
-                    }
+                    })
                     
                     # 发送错误事件
-                    await event_queue.put(format_sse_event("task_error", {
+                    await emit_event(event_queue, "task_error", {
                         "episode": task_data["episode_key"],
                         "scene": task_data["scene_key"],
                         "prompt_index": str(task_data["prompt_index"]),
                         "task_id": subtask_id,
                         "error": str(e),
                         "worker_id": worker_id + 1
-                    }))
+                    }, request_id=request_id)
                 
                 finally:
                     # 标记任务完成
                     global_task_queue.task_done()
                     
-                    # 发送进度更新 - 改为使用请求元数据中的任务ID列表计算进度
+                    # 发送进度更新 - 使用请求元数据中的状态计数计算进度
                     if request_id in global_request_metadata:
                         request_meta = global_request_metadata[request_id]
                         expected_total = request_meta["total_tasks"]
-                        task_ids_list = request_meta["task_ids"]
-                        
-                        # 使用单独变量保存计数结果
-                        completed_count = 0
-                        waiting_count = 0
                         
-                        for current_id in task_ids_list:
-                            if current_id in global_tasks_status:
-                                status = global_tasks_status[current_id]["status"] 
-                                if status in ["COMPLETED", "ERROR"]:
-                                    completed_count += 1
-                                elif status == "WAITING":
-                                    waiting_count += 1
+                        # 状态计数由update_task_status增量维护
+                        status_counts = request_meta["status_counts"]
+                        completed_count = status_counts["COMPLETED"] + status_counts["ERROR"]
+                        waiting_count = status_counts["WAITING"]
                         
                         print(f"工作协程 #{worker_id + 1} - 请求 {request_id} 进度更新: 完成={completed_count}/{expected_total}, 等待中={waiting_count}")
                         
                         # 发送进度更新
-                        await event_queue.put(format_sse_event("progress", {
+                        await emit_event(event_queue, "progress", {
                             "completed": completed_count,
                             "total": expected_total,
                             "waiting": waiting_count,
                             "percentage": int(completed_count * 100 / expected_total) if expected_total else 0
-                        }))
+                        }, request_id=request_id)
                         
                         # 检查请求的所有任务是否完成 - 只有当没有等待中的任务，且完成数等于总数时才真正完成
                         if completed_count == expected_total and waiting_count == 0:
                             print(f"工作协程 #{worker_id + 1} - 请求 {request_id} 的所有 {expected_total} 个任务已完成")
-                            await event_queue.put(format_sse_event("all_tasks_completed", {
+                            await emit_event(event_queue, "all_tasks_completed", {
                                 "request_id": request_id,
                                 "completed": completed_count,
                                 "total": expected_total
-                            }))
+                            }, request_id=request_id)
                     else:
                         # 备用方法：如果没有元数据，使用过滤方法计算
                         request_tasks = [t for t_id, t in global_tasks_status.items() if t["request_id"] == request_id]
@@ -421,21 +514,21 @@ async def worker_process(worker_id: int):
                         
                         print(f"工作协程 #{worker_id + 1} - 备用进度方法，请求 {request_id} 完成={len(completed_tasks)}/{len(request_tasks)}, 等待中={len(waiting_tasks)}")
                         
-                        await event_queue.put(format_sse_event("progress", {
+                        await emit_event(event_queue, "progress", {
                             "completed": len(completed_tasks),
                             "total": len(request_tasks),
                             "waiting": len(waiting_tasks),
                             "percentage": int(len(completed_tasks) * 100 / len(request_tasks)) if request_tasks else 0
-                        }))
+                        }, request_id=request_id)
                         
                         # 检查请求的所有任务是否完成 - 确保没有等待中的任务
                         if len(completed_tasks) == len(request_tasks) and len(waiting_tasks) == 0 and len(request_tasks) > 0:
                             print(f"工作协程 #{worker_id + 1} - 请求 {request_id} 的所有任务已完成 (备用方法)")
-                            await event_queue.put(format_sse_event("all_tasks_completed", {
+                            await emit_event(event_queue, "all_tasks_completed", {
                                 "request_id": request_id,
                                 "completed": len(completed_tasks),
                                 "total": len(request_tasks)
-                            }))
+                            }, request_id=request_id)
             
             except asyncio.CancelledError:
                 print(f"工作协程 #{worker_id + 1} 被取消")
@@ -1,6 +1,7 @@
 import os
 import io
 import pickle
+import asyncio
 from typing import List, Dict, Any, Tuple, Optional
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -1726,6 +1727,8 @@ async def create_script_pdf(
     
     # 完整文件路径
     full_path = os.path.join(output_dir, filename)
+    # 先写入临时文件再原子替换，读取方永远不会看到写了一半的PDF
+    tmp_path = f"{full_path}.{os.getpid()}.tmp"
     
     # 创建PDF文档
     if with_progress:
@@ -1745,14 +1748,18 @@ async def create_script_pdf(
         pdf_data = await generate_script_pdf(
             script_content=script_content, 
             image_data=image_data, 
-            output_path=full_path if SAVE_FILES_LOCALLY else None,
+            output_path=tmp_path if SAVE_FILES_LOCALLY else None,
             task_id=task_id,
             progress_callback=update_progress
         )
+        if SAVE_FILES_LOCALLY and os.path.exists(tmp_path):
+            os.replace(tmp_path, full_path)
     except Exception as e:
         print(f"生成PDF时发生错误: {str(e)}")
         import traceback
         print(traceback.format_exc())
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         
     # 如果没有保存到本地但生成了PDF数据，先不保存，等待MinIO上传结果
     local_saved = SAVE_FILES_LOCALLY and os.path.exists(full_path)
@@ -1786,8 +1793,9 @@ async def create_script_pdf(
     # MinIO上传失败且未保存到本地，但有PDF数据，确保保存到本地
     if not minio_upload_success and not local_saved and pdf_data:
         try:
-            with open(full_path, 'wb') as f:
+            with open(tmp_path, 'wb') as f:
                 f.write(pdf_data)
+            os.replace(tmp_path, full_path)
             print(f"MinIO上传失败，PDF数据已保存到本地文件: {full_path}")
             local_saved = True
         except Exception as e:
@@ -1796,6 +1804,10 @@ async def create_script_pdf(
     # 如果MinIO上传成功，返回MinIO URL，否则返回本地路径
     return minio_url if minio_upload_success else full_path
 
+def create_script_pdf_sync(**kwargs) -> str:
+    """create_script_pdf的同步入口，供进程池在子进程中调用"""
+    return asyncio.run(create_script_pdf(**kwargs))
+
 # 添加一个新函数，用于从generation_states文件夹读取剧本并生成PDF
 async def generate_pdf_from_script_file(
     script_file_path: str,
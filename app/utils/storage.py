@@ -1,17 +1,35 @@
 import os
 import pickle
+import asyncio
 from typing import Dict, Any, Optional
 import json
 from datetime import datetime
 import io
+import hashlib
 from app.core.config import GENERATION_STATES_DIR, PARTIAL_CONTENTS_DIR, MINIO_ENABLED, SAVE_FILES_LOCALLY
+from app.utils.text_utils import extract_scene_prompts_cached
 
 # 内存中的状态存储
 generation_states = {}
 episode_partial_contents = {}  # 保存每个任务每一集的部分生成内容
 
-def save_generation_state(task_id, current_episode, full_script):
-    """保存生成状态到内存和文件"""
+# 后台写入部分内容的队列：队列中只放key，同一key的多次提交只保留最新内容
+_save_queue: Optional[asyncio.Queue] = None
+_pending_partial_contents = {}
+_save_worker_task: Optional[asyncio.Task] = None
+
+# 每个key最近一次写入本地文件的(长度, 摘要)，新内容以它为前缀时只追加新增部分；只保存摘要，不在内存中保留第二份全文
+_persisted_partial_contents = {}
+
+def _content_digest(content):
+    """计算内容摘要，用于判断新内容是否以已写入内容为前缀"""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+def save_generation_state(task_id, current_episode, full_script, scene_prompts=None):
+    """保存生成状态到内存和文件
+    
+    scene_prompts为剧本的画面描述词提取结果，剧本生成完成时随状态一起保存，之后读取无需重新解析剧本。
+    """
     # 确保script_content是UTF-8编码的字符串
     if isinstance(full_script, bytes):
         full_script = full_script.decode('utf-8')
@@ -21,6 +39,8 @@ def save_generation_state(task_id, current_episode, full_script):
         "full_script": full_script,
         "timestamp": datetime.now().isoformat()
     }
+    if scene_prompts is not None:
+        state["scene_prompts"] = scene_prompts
     
     # 保存到内存
     generation_states[task_id] = state
@@ -118,6 +138,22 @@ def load_generation_state(task_id):
     
     return state
 
+def load_generation_prompts(task_id):
+    """加载剧本的画面描述词，状态不存在时返回None
+    
+    提取结果记录在内存中的状态字典上；save_generation_state每次都会创建新的状态字典，
+    剧本更新后不会读到旧的结果。
+    """
+    state = load_generation_state(task_id)
+    if not state:
+        return None
+    
+    prompts_dict = state.get("scene_prompts")
+    if prompts_dict is None:
+        prompts_dict = extract_scene_prompts_cached(state.get("full_script", ""))
+        state["scene_prompts"] = prompts_dict
+    return prompts_dict
+
 def find_latest_state_for_any_client():
     """查找所有任务中最新的状态文件"""
     try:
@@ -175,8 +211,13 @@ def find_latest_state_for_any_client():
     
     return None
 
-def save_partial_content(task_id, episode, content):
-    """保存部分生成内容到文件和内存"""
+def save_partial_content(task_id, episode, content, final=False, update_memory=True):
+    """保存部分生成内容到文件和内存
+    
+    final为True表示该集内容已生成完毕，写入后不再保留追加写入所需的记录。
+    update_memory为False时不更新内存中的内容：后台写入线程使用，内存已由queue_partial_content在事件循环中更新，
+    线程中再写可能用旧快照覆盖更新的内容。
+    """
     from app.core.config import SAVE_FILES_LOCALLY
     
     # 确保content是UTF-8编码的字符串
@@ -185,7 +226,8 @@ def save_partial_content(task_id, episode, content):
         
     # 保存到内存
     key = f"{task_id}_{episode}"
-    episode_partial_contents[key] = content
+    if update_memory:
+        episode_partial_contents[key] = content
     
     # 创建元数据
     meta = {
@@ -200,10 +242,21 @@ def save_partial_content(task_id, episode, content):
         # 确保目录存在
         os.makedirs(PARTIAL_CONTENTS_DIR, exist_ok=True)
         
-        # 保存内容到文件
+        # 保存内容到文件：生成过程中内容只会增长，此时只追加新增部分，否则整体重写
         file_path = os.path.join(PARTIAL_CONTENTS_DIR, f"{task_id}_{episode}.txt")
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(content)
+        previous = _persisted_partial_contents.get(key)
+        if (previous is not None and len(content) >= previous[0]
+                and _content_digest(content[:previous[0]]) == previous[1] and os.path.exists(file_path)):
+            if len(content) > previous[0]:
+                with open(file_path, "a", encoding="utf-8") as f:
+                    f.write(content[previous[0]:])
+        else:
+            with open(file_path, "w", encoding="utf-8") as f:
+                f.write(content)
+        if final:
+            _persisted_partial_contents.pop(key, None)
+        else:
+            _persisted_partial_contents[key] = (len(content), _content_digest(content))
             
         # 保存元数据到文件
         meta_path = os.path.join(PARTIAL_CONTENTS_DIR, f"{task_id}_{episode}_meta.json")
@@ -238,6 +291,46 @@ def save_partial_content(task_id, episode, content):
         except Exception as e:
             print(f"MinIO存储部分内容失败: {str(e)}")
 
+async def _save_worker():
+    """后台写入部分内容，磁盘和MinIO的阻塞I/O放到线程中执行，不阻塞SSE读取"""
+    while True:
+        key = await _save_queue.get()
+        try:
+            pending = _pending_partial_contents.pop(key, None)
+            if pending is not None:
+                await asyncio.to_thread(save_partial_content, *pending, update_memory=False)
+        except Exception as e:
+            print(f"后台保存部分内容失败: {str(e)}")
+        finally:
+            _save_queue.task_done()
+
+def queue_partial_content(task_id, episode, content, final=False):
+    """提交部分内容到后台写入队列后立即返回，内存中的内容同步更新"""
+    global _save_queue, _save_worker_task
+    
+    key = f"{task_id}_{episode}"
+    episode_partial_contents[key] = content
+    
+    if _save_queue is None:
+        _save_queue = asyncio.Queue()
+    if _save_worker_task is None or _save_worker_task.done():
+        _save_worker_task = asyncio.create_task(_save_worker())
+    
+    # 同一key已在队列中等待时只替换内容，旧快照直接丢弃
+    if key not in _pending_partial_contents:
+        _save_queue.put_nowait(key)
+    _pending_partial_contents[key] = (task_id, episode, content, final)
+
+def release_partial_content_tracking(task_id):
+    """任务结束时清除该任务各集的追加写入记录，取消或出错而没有最终保存的剧集也不会一直占用内存"""
+    prefix = f"{task_id}_"
+    for key in [key for key in _persisted_partial_contents if key.startswith(prefix)]:
+        _persisted_partial_contents.pop(key, None)
+    # 队列中尚未写入的内容按最终保存处理，写入后同样不再保留记录
+    for key, pending in _pending_partial_contents.items():
+        if key.startswith(prefix):
+            _pending_partial_contents[key] = pending[:3] + (True,)
+
 def get_partial_content(task_id, episode):
     """获取部分生成内容"""
     # 先尝试从内存获取
@@ -1,5 +1,19 @@
+import hashlib
 import re
 
+# 画面描述词提取结果缓存 {剧本内容的64位摘要: 提示词字典}，以摘要为键，不在缓存中保留整份剧本文本
+_SCENE_PROMPTS_CACHE_SIZE = 256
+_scene_prompts_cache = {}
+
+# 预编译的剧名和分集目录行匹配模式
+_TITLE_RE = re.compile(r'《.*?》')
+_EPISODE_LINE_RE = re.compile(r'^第\d+集')
+
+# 预编译的画面描述词提取模式：集数、场次标题、场次编号中的集数
+_EPISODE_NUM_RE = re.compile(r'第(\d+)集')
+_SCENE_RE = re.compile(r'(?:###\s*)?场次(\d+-\d+)[：:]')
+_SCENE_EPISODE_RE = re.compile(r'(\d+)-\d+')
+
 def extract_title_and_directory(full_script: str) -> str:
     """提取剧名和目录
     
@@ -15,7 +29,7 @@ def extract_title_and_directory(full_script: str) -> str:
     result = ""
     
     # 1. 提取剧名 (通常是《...》格式)
-    title_match = re.search(r'《.*?》', full_script[:1000])
+    title_match = _TITLE_RE.search(full_script[:1000])
     if title_match:
         title = title_match.group(0)
         result += f"剧名：{title}\n\n"
@@ -49,7 +63,7 @@ def extract_title_and_directory(full_script: str) -> str:
         
         # 提取所有"第XX集"格式的行
         for line in lines:
-            if re.match(r'^第\d+集', line.strip()):
+            if _EPISODE_LINE_RE.match(line.strip()):
                 directory_lines.append(line.strip())
         
         if directory_lines:
@@ -97,7 +111,7 @@ def extract_scene_prompts(script_text):
                 next_line = lines[j].strip()
                 # 处理"集数：第X集"或"第X集"格式
                 if ('集数：' in next_line or '集' in next_line) and '第' in next_line:
-                    episode_match = re.search(r'第(\d+)集', next_line)
+                    episode_match = _EPISODE_NUM_RE.search(next_line)
                     if episode_match:
                         current_episode = int(episode_match.group(1))
                         # print(f"在剧本开头找到集数: {current_episode}")
@@ -117,7 +131,7 @@ def extract_scene_prompts(script_text):
         
         # 检查是否是新的集
         if ('集数：第' in line or line.startswith('第')) and '集' in line:
-            episode_match = re.search(r'第(\d+)集', line)
+            episode_match = _EPISODE_NUM_RE.search(line)
             if episode_match:
                 current_episode = int(episode_match.group(1))
                 # print(f"在处理过程中发现新集数: {current_episode}")
@@ -126,12 +140,12 @@ def extract_scene_prompts(script_text):
         
         # 检测场次 - 同时支持"场次X-X："和"### 场次X-X："格式
         elif ('场次' in line) and ('：' in line or ':' in line):
-            scene_match = re.search(r'(?:###\s*)?场次(\d+-\d+)[：:]', line)
+            scene_match = _SCENE_RE.search(line)
             if scene_match:
                 current_scene = scene_match.group(1)
                 
                 # 从场次编号中提取集数（如场次5-3中的5）
-                scene_ep_match = re.match(r'(\d+)-\d+', current_scene)
+                scene_ep_match = _SCENE_EPISODE_RE.match(current_scene)
                 if scene_ep_match:
                     scene_episode = int(scene_ep_match.group(1))
                     # 如果场次编号中的集数与当前集数不同，更新当前集数
@@ -208,21 +222,43 @@ def extract_scene_prompts(script_text):
     
     return renumbered_prompts
 
-def format_scene_prompts(prompts_dict, specific_episode=None):
+def scene_sort_key(scene):
+    """场次编号"X-Y"的排序键，按数值而不是字符串排序（1-2排在1-10之前）"""
+    return tuple(map(int, scene.split('-')))
+
+def extract_scene_prompts_cached(script_text):
     """
-    将提取的画面描述词格式化为指定的输出格式
+    按剧本内容摘要缓存extract_scene_prompts的结果，同一剧本重复提取时不再重新解析
+    
+    返回的字典在多个请求间共享，调用方只能读取，不能修改。
+    """
+    if not script_text:
+        return {}
+    
+    script_hash = hashlib.blake2b(script_text.encode("utf-8"), digest_size=8).digest()
+    prompts_dict = _scene_prompts_cache.get(script_hash)
+    if prompts_dict is None:
+        prompts_dict = extract_scene_prompts(script_text)
+        if len(_scene_prompts_cache) >= _SCENE_PROMPTS_CACHE_SIZE:
+            # 淘汰最早加入的条目
+            _scene_prompts_cache.pop(next(iter(_scene_prompts_cache)), None)
+        _scene_prompts_cache[script_hash] = prompts_dict
+    return prompts_dict
+
+def iter_scene_prompts(prompts_dict, specific_episode=None):
+    """
+    逐集格式化画面描述词，每格式化完一集就产出一集，调用方可以边格式化边发送
     
     Args:
         prompts_dict (dict): 按集数和场次组织的画面描述词字典
         specific_episode (int, optional): 指定要格式化的集数，None表示格式化所有集
         
-    Returns:
-        dict: 按集数组织的格式化文本，key为集数字符串，value为该集的格式化文本
+    Yields:
+        tuple: (集数字符串, 该集的格式化文本)
     """
-    if not prompts_dict:
-        return {"1": "未找到画面描述词"}
-    
-    result = {}
+    if not prompts_dict and specific_episode is None:
+        yield "1", "未找到画面描述词"
+        return
     
     # 确定要处理的集数
     episodes_to_format = [specific_episode] if specific_episode is not None else sorted(prompts_dict.keys())
@@ -230,14 +266,14 @@ def format_scene_prompts(prompts_dict, specific_episode=None):
     # 按集数格式化
     for episode in episodes_to_format:
         if episode not in prompts_dict:
-            result[str(episode)] = f"未找到第{episode}集的画面描述词"
+            yield str(episode), f"未找到第{episode}集的画面描述词"
             continue
             
         output = []
         output.append(f"第{episode}集：")
         
         # 按场次排序
-        for scene in sorted(prompts_dict[episode].keys(), key=lambda x: [int(i) for i in x.split('-')]):
+        for scene in sorted(prompts_dict[episode], key=scene_sort_key):
             output.append(f"场次{scene}：")
             
             # 添加该场次的所有画面描述词
@@ -247,6 +283,17 @@ def format_scene_prompts(prompts_dict, specific_episode=None):
             output.append("")  # 空行分隔场次
         
         # 将该集的输出合并为字符串
-        result[str(episode)] = "\n".join(output)
+        yield str(episode), "\n".join(output)
+
+def format_scene_prompts(prompts_dict, specific_episode=None):
+    """
+    将提取的画面描述词格式化为指定的输出格式
     
-    return result 
\ No newline at end of file
+    Args:
+        prompts_dict (dict): 按集数和场次组织的画面描述词字典
+        specific_episode (int, optional): 指定要格式化的集数，None表示格式化所有集
+        
+    Returns:
+        dict: 按集数组织的格式化文本，key为集数字符串，value为该集的格式化文本
+    """
+    return dict(iter_scene_prompts(prompts_dict, specific_episode))